@@ -0,0 +1,190 @@
+import array
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+# Layout of a theory artifact, all integers little endian:
+#   header: magic, format version, reserved, metadata offset, metadata length
+#   term table: u32 count, u32 end offsets of each term, utf-8 bytes of all terms
+#   one section per theory: u32 stream of (conclusion id, antecedent length, antecedent ids...) per rule
+#   records section: u32 stream of (record length, term ids...) per record
+#   metadata: JSON with the section directory, mutex sets as term ids, restrictions, seed and durationTrain
+MAGIC = b'HEROART\0'
+VERSION = 1
+headerFormat = '<8sIIQQ'
+headerSize = struct.calcsize(headerFormat)
+
+def qualityPrefix(s):
+    if '_' in s:
+        return s[:s.find('_')]
+    return ''
+
+def u32Bytes(values):
+    retq = array.array('I', values)
+    if 'big' == sys.byteorder:
+        retq.byteswap()
+    return retq.tobytes()
+
+def u32Values(buf):
+    retq = array.array('I')
+    retq.frombytes(buf)
+    if 'big' == sys.byteorder:
+        retq.byteswap()
+    return retq
+
+def writeArtifact(path, data):
+    terms = []
+    termIds = {}
+    def intern(t):
+        if t not in termIds:
+            termIds[t] = len(terms)
+            terms.append(t)
+        return termIds[t]
+    mutexsets = [[intern(t) for t in sorted(ms)] for ms in data["mutexsets"]]
+    theories = []
+    for ms, theory in zip(data["mutexsets"], data["theory"]):
+        stream = []
+        for r in theory:
+            stream.append(intern(r[1]))
+            stream.append(len(r[0]))
+            stream.extend([intern(t) for t in sorted(r[0])])
+        # keyed like testing.makePref2TheoryMap, by what the theory concludes
+        prefix = qualityPrefix(theory[0][1]) if theory else qualityPrefix(list(ms)[0])
+        theories.append((prefix, len(theory), u32Bytes(stream)))
+    stream = []
+    for r in data["records"]:
+        stream.append(len(r))
+        stream.extend([intern(t) for t in r])
+    recordBytes = u32Bytes(stream)
+    encodedTerms = [t.encode('utf-8') for t in terms]
+    ends = []
+    end = 0
+    for t in encodedTerms:
+        end = end + len(t)
+        ends.append(end)
+    termBytes = u32Bytes([len(terms)] + ends) + b''.join(encodedTerms)
+    restrictions = data.get("restrictions")
+    if None != restrictions:
+        restrictions = {k: sorted(v) for k, v in restrictions.items()}
+    meta = {"version": VERSION, "mutexsets": mutexsets, "restrictions": restrictions, "seed": data.get("seed"), "durationTrain": data.get("durationTrain"), "theories": []}
+    with open(path + ".tmp", "wb") as outfile:
+        outfile.write(bytes(headerSize))
+        meta["terms"] = [outfile.tell(), len(termBytes), len(terms)]
+        outfile.write(termBytes)
+        for prefix, ruleCount, theoryBytes in theories:
+            meta["theories"].append([prefix, outfile.tell(), len(theoryBytes), ruleCount])
+            outfile.write(theoryBytes)
+        meta["records"] = [outfile.tell(), len(recordBytes), len(data["records"])]
+        outfile.write(recordBytes)
+        metaBytes = json.dumps(meta).encode('utf-8')
+        metaOffset = outfile.tell()
+        outfile.write(metaBytes)
+        outfile.seek(0)
+        outfile.write(struct.pack(headerFormat, MAGIC, VERSION, 0, metaOffset, len(metaBytes)))
+    os.replace(path + ".tmp", path)
+
+def isArtifact(path):
+    with open(path, 'rb') as infile:
+        return MAGIC == infile.read(len(MAGIC))
+
+def openArtifact(path):
+    with open(path, 'rb') as infile:
+        buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, _, metaOffset, metaLength = struct.unpack_from(headerFormat, buf, 0)
+        if MAGIC != magic:
+            raise ValueError("%s is not a theory artifact" % path)
+        if VERSION != version:
+            raise ValueError("%s has artifact version %d, expected %d" % (path, version, VERSION))
+        meta = json.loads(bytes(buf[metaOffset:metaOffset + metaLength]).decode('utf-8'))
+        offset, length, count = meta["terms"]
+        ends = u32Values(buf[offset:offset + 4*(1 + count)])[1:]
+        blob = buf[offset + 4*(1 + count):offset + length]
+        terms = []
+        start = 0
+        for end in ends:
+            terms.append(blob[start:end].decode('utf-8'))
+            start = end
+    except (struct.error, KeyError, IndexError) as e:
+        buf.close()
+        raise ValueError("%s is not a valid theory artifact: %s" % (path, e))
+    except ValueError:
+        buf.close()
+        raise
+    return {"buffer": buf, "meta": meta, "terms": terms, "theories": {}}
+
+def closeArtifact(artifact):
+    artifact["buffer"].close()
+
+def artifactPrefixes(artifact):
+    return [x[0] for x in artifact["meta"]["theories"]]
+
+def decodeTheory(artifact, entry):
+    _, offset, length, ruleCount = entry
+    terms = artifact["terms"]
+    stream = u32Values(artifact["buffer"][offset:offset + length])
+    theory = []
+    k = 0
+    try:
+        for _ in range(ruleCount):
+            conclusion, n = stream[k], stream[k + 1]
+            theory.append((frozenset([terms[x] for x in stream[k + 2:k + 2 + n]]), terms[conclusion]))
+            k = k + 2 + n
+    except IndexError as e:
+        raise ValueError("bad rule stream for prefix %s: %s" % (repr(entry[0]), e))
+    return theory
+
+def loadTheory(artifact, prefix):
+    if prefix not in artifact["theories"]:
+        entries = [x for x in artifact["meta"]["theories"] if prefix == x[0]]
+        if not entries:
+            raise KeyError(prefix)
+        artifact["theories"][prefix] = decodeTheory(artifact, entries[0])
+    return artifact["theories"][prefix]
+
+def loadTheories(artifact):
+    return [decodeTheory(artifact, x) for x in artifact["meta"]["theories"]]
+
+def loadRecords(artifact):
+    offset, length, count = artifact["meta"]["records"]
+    terms = artifact["terms"]
+    stream = u32Values(artifact["buffer"][offset:offset + length])
+    records = []
+    k = 0
+    for _ in range(count):
+        n = stream[k]
+        records.append([terms[x] for x in stream[k + 1:k + 1 + n]])
+        k = k + 1 + n
+    return records
+
+def loadMutexsets(artifact):
+    terms = artifact["terms"]
+    return [set([terms[x] for x in ms]) for ms in artifact["meta"]["mutexsets"]]
+
+def loadRunData(path, records=True):
+    # the dict trainWithSplitInternal used to pickle, from either an artifact or an old pickle
+    if not isArtifact(path):
+        with open(path, 'rb') as infile:
+            return pickle.load(infile)
+    artifact = openArtifact(path)
+    try:
+        meta = artifact["meta"]
+        restrictions = meta["restrictions"]
+        if None != restrictions:
+            restrictions = {k: set(v) for k, v in restrictions.items()}
+        retq = {"durationTrain": meta["durationTrain"], "theory": loadTheories(artifact), "mutexsets": loadMutexsets(artifact), "restrictions": restrictions, "seed": meta["seed"]}
+        if records:
+            retq["records"] = loadRecords(artifact)
+    except (KeyError, IndexError, TypeError, AttributeError, struct.error) as e:
+        # callers only need to handle ValueError for a damaged artifact
+        raise ValueError("%s is not a valid theory artifact: %s" % (path, repr(e)))
+    finally:
+        closeArtifact(artifact)
+    return retq
+
+def convertPickle(picklePath, artifactPath):
+    with open(picklePath, 'rb') as infile:
+        writeArtifact(artifactPath, pickle.load(infile))
@@ -0,0 +1,176 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import testing
+import training
+
+# Scaling benchmarks on synthetic corpora shaped like records_dfl.txt: every record is an object class (no prefix)
+# followed by one value of each quality, the values being prefixed by the quality and mutually exclusive.
+# Each class has a typical value per quality, and a quality that is not typical tends to follow the previous one.
+# Results are written one JSON object per line, so that runs on different commits can be compared with compareResults.
+
+def syntheticRecords(recordCount, mutexCount=15, valuesPerMutex=6, classCount=20, correlation=0.9, missingRate=0.03, duplicateRate=0.1, seed=0):
+    rng = random.Random(seed)
+    classes = ["class%d" % k for k in range(classCount)]
+    qualities = ["quality%d" % k for k in range(mutexCount)]
+    typical = {c: [rng.randrange(valuesPerMutex) for _ in qualities] for c in classes}
+    records = []
+    while len(records) < recordCount:
+        if records and (rng.random() < duplicateRate):
+            records.append(list(rng.choice(records)))
+            continue
+        c = rng.choice(classes)
+        r = [c]
+        previous = rng.randrange(valuesPerMutex)
+        for k, q in enumerate(qualities):
+            if rng.random() < correlation:
+                v = typical[c][k]
+            elif rng.random() < 0.5:
+                v = previous
+            else:
+                v = rng.randrange(valuesPerMutex)
+            previous = v
+            if rng.random() >= missingRate:
+                r.append("%s_value%d" % (q, v))
+        records.append(r)
+    return records
+
+def syntheticTheory(records, ruleCount, prefix='', maxAntecedent=3, seed=0):
+    # rules made of facts that occur together in a record, concluding a fact of the given prefix from the same record
+    rng = random.Random(seed)
+    records = [r for r in records if any([prefix == training.qualityPrefix(x) for x in r])]
+    theory = []
+    for _ in range(ruleCount):
+        r = rng.choice(records)
+        conclusions = [x for x in r if prefix == training.qualityPrefix(x)]
+        others = [x for x in r if prefix != training.qualityPrefix(x)]
+        theory.append((frozenset(rng.sample(others, rng.randint(0, min(maxAntecedent, len(others))))), rng.choice(conclusions)))
+    return theory
+
+def queryPremises(records, prefix, count, seed=0):
+    rng = random.Random(seed)
+    return [frozenset([x for x in rng.choice(records) if prefix != training.qualityPrefix(x)]) for _ in range(count)]
+
+def bestOf(repeats, f):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if (None == best) or (elapsed < best):
+            best = elapsed
+    return best
+
+def benchmarkTraining(recordCount, mutexCount, valuesPerMutex, classCount=20, restrictions=None, seed=0):
+    records = syntheticRecords(recordCount, mutexCount=mutexCount, valuesPerMutex=valuesPerMutex, classCount=classCount, seed=seed)
+    mutexsets = training.mutexsetsFromRecords(records)
+    vocabulary = sorted(set().union(*records))
+    dataset = training.datasetFromRecords(records)
+    calls = []
+    ruleSearch = training.ruleSearch
+    def timedRuleSearch(*args, **kwargs):
+        start = time.perf_counter()
+        retq = ruleSearch(*args, **kwargs)
+        calls.append(time.perf_counter() - start)
+        return retq
+    training.ruleSearch = timedRuleSearch
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            theories = training.multiHeRO(dataset, mutexsets, vocabulary, restrictions=restrictions)
+        elapsed = time.perf_counter() - start
+    finally:
+        training.ruleSearch = ruleSearch
+    calls.sort()
+    return {"multiHeRO": elapsed, "ruleSearchCalls": len(calls), "ruleSearchTotal": sum(calls), "ruleSearchMean": sum(calls)/max(1, len(calls)), "ruleSearchMax": calls[-1] if calls else 0.0, "rules": sum([len(t) for t in theories]), "vocabulary": len(vocabulary), "pairs": len(dataset)}
+
+def benchmarkInference(recordCount, mutexCount, valuesPerMutex, ruleCount, queryCount=500, classCount=20, repeats=3, seed=0):
+    records = syntheticRecords(recordCount, mutexCount=mutexCount, valuesPerMutex=valuesPerMutex, classCount=classCount, seed=seed)
+    theory = syntheticTheory(records, ruleCount, seed=seed)
+    premises = queryPremises(records, '', queryCount, seed=seed)
+    compiled = testing.compileTheory(theory)
+    compiledCF = testing.compileCounterfactuals(theory)
+    explained = [p for p in premises if None != testing.getAndExplainConclusion(p, theory)[0]]
+    targets = [(p, random.Random(seed + k).choice(theory)[1]) for k, p in enumerate(explained[:max(1, queryCount//10)])]
+    retq = {}
+    retq["explain"] = bestOf(repeats, lambda: [testing.getAndExplainConclusion(p, theory) for p in premises])/len(premises)
+    retq["explainCompiled"] = bestOf(repeats, lambda: [testing.getAndExplainConclusionCompiled(p, compiled) for p in premises])/len(premises)
+    retq["explainBatch"] = bestOf(repeats, lambda: testing.batchExplainConclusions(premises, theory))/len(premises)
+    retq["rank"] = bestOf(repeats, lambda: [testing.getConclusionsRanking(p, [theory]) for p in premises])/len(premises)
+    retq["top3"] = bestOf(repeats, lambda: [testing.topConclusions(p, [theory], 3) for p in premises])/len(premises)
+    retq["top3Compiled"] = bestOf(repeats, lambda: [testing.topConclusions(p, [compiled], 3, compiled=True) for p in premises])/len(premises)
+    if targets:
+        retq["counterfactual"] = bestOf(repeats, lambda: [testing.getAndCounterfactuallyExplainConclusion(p, theory, c) for p, c in targets])/len(targets)
+        retq["counterfactualCompiled"] = bestOf(repeats, lambda: [testing.getAndCounterfactuallyExplainConclusionCompiled(p, compiledCF, c) for p, c in targets])/len(targets)
+        retq["counterfactualAll"] = bestOf(repeats, lambda: [testing.getAndCounterfactuallyExplainAllConclusions(p, compiledCF) for p, _ in targets])/len(targets)
+    retq["compile"] = bestOf(repeats, lambda: testing.compileCounterfactuals(theory))
+    return retq
+
+# every sweep varies one parameter around a base configuration
+trainingBase = {"recordCount": 1000, "mutexCount": 15, "valuesPerMutex": 6}
+inferenceBase = {"recordCount": 2000, "mutexCount": 15, "valuesPerMutex": 6, "ruleCount": 200}
+sweeps = {
+    "quick": [
+        ("training", "recordCount", [250, 500, 1000]),
+        ("inference", "ruleCount", [50, 200, 800]),
+    ],
+    "full": [
+        ("training", "recordCount", [250, 500, 1000, 2000, 4000, 8000]),
+        ("training", "mutexCount", [5, 10, 15, 20, 30]),
+        ("training", "valuesPerMutex", [3, 6, 12, 24]),
+        ("inference", "ruleCount", [50, 100, 200, 400, 800, 1600, 3200]),
+        ("inference", "mutexCount", [5, 10, 15, 20, 30]),
+        ("inference", "valuesPerMutex", [3, 6, 12, 24]),
+    ],
+}
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runBenchmarks(outPath, sweep="quick", seed=0):
+    commit = gitCommit()
+    with open(outPath, "w") as outfile:
+        for kind, parameter, values in sweeps[sweep]:
+            for value in values:
+                params = dict(trainingBase if "training" == kind else inferenceBase)
+                params[parameter] = value
+                if "training" == kind:
+                    metrics = benchmarkTraining(seed=seed, **params)
+                else:
+                    metrics = benchmarkInference(seed=seed, **params)
+                result = {"benchmark": kind, "sweep": parameter, "params": params, "seed": seed, "metrics": metrics, "commit": commit, "python": platform.python_version()}
+                outfile.write(json.dumps(result, sort_keys=True) + "\n")
+                outfile.flush()
+                print("%s %s=%s %s" % (kind, parameter, value, " ".join(["%s=%.4g" % (k, v) for k, v in sorted(metrics.items())])))
+
+def loadResults(path):
+    with open(path) as infile:
+        return [json.loads(line) for line in infile if line.strip()]
+
+def compareResults(oldPath, newPath):
+    # ratio new/old of every timing present in both runs, by benchmark and parameters
+    def key(result):
+        return (result["benchmark"], json.dumps(result["params"], sort_keys=True))
+    old = {key(x): x for x in loadResults(oldPath)}
+    for result in loadResults(newPath):
+        if key(result) not in old:
+            continue
+        before = old[key(result)]["metrics"]
+        ratios = ["%s=%.2fx" % (k, v/before[k]) for k, v in sorted(result["metrics"].items()) if isinstance(v, float) and before.get(k)]
+        print("%s %s %s" % (result["benchmark"], key(result)[1], " ".join(ratios)))
+
+if "__main__" == __name__:
+    if (3 == len(sys.argv)) and sys.argv[1].endswith(".jsonl") and sys.argv[2].endswith(".jsonl"):
+        compareResults(sys.argv[1], sys.argv[2])
+    else:
+        runBenchmarks(sys.argv[1] if 1 < len(sys.argv) else "benchmark.jsonl", sweep=sys.argv[2] if 2 < len(sys.argv) else "quick")
@@ -1,24 +1,25 @@
-import pickle
+import artifact
 import testing
 
 dataFileName = 'knrestriction_log_0.70_9.log'
 
 # Initialization:
-#    load from pickle file
-with open(dataFileName, 'rb') as infile:
-    data = pickle.load(infile)
+#    open the training artifact; nothing but its directory is read until a theory or the records are asked for
+#    (a run pickled by older versions of training.py can be converted with artifact.convertPickle)
+run = artifact.openArtifact(dataFileName)
 
 #
-#    theories, mutexsets etc are in a list in the pickle, but it is convenient to just have access to a theory for
-# a given prefix directly
+#    the artifact stores one theory per prefix, it is convenient to just have access to a theory for a given
+# prefix directly
 #    e.g., pref2Theory[''] is the theory to identify object type from the provided data
 #    pref2Theory['transparency'] is the theory for transparency etc.
-pref2Theory = testing.makePref2TheoryMap(data['theory'])
+pref2Theory = {pref: artifact.loadTheory(run, pref) for pref in artifact.artifactPrefixes(run)}
 #
 #    get a list of records used for test; each record is a complete situation, i.e. full knowledge of the object
 # a query is made by splitting this information into a conclusion, ie one of the facts in the situation, and all
 # other facts of the situation make up the premise
-testRecords = data['records'][int(len(data['records'])*0.7):]
+records = artifact.loadRecords(run)
+testRecords = records[int(len(records)*0.7):]
 #
 #    create a list of test records on which the theory and human annotators do not agree
 def getFailedRecords(records, prefix):
@@ -53,6 +54,11 @@ conclusion, premise = testing.makeTestcase(testRecords[0], '')
 maxSupportingRule, otherSupportingRules = testing.getAndExplainConclusion(premise, pref2Theory[''])
 print(testing.printRule(maxSupportingRule))
 _ = [print(testing.printRule(x)) for x in otherSupportingRules]
+#
+# When many queries go to the same theory, compile it once; the answers are the same as above, but only rules
+#   that can apply to the premise are looked at
+compiledTheory = testing.compileTheory(pref2Theory[''])
+maxSupportingRule, otherSupportingRules = testing.getAndExplainConclusionCompiled(premise, compiledTheory)
 
 
 
@@ -68,6 +74,14 @@ _ = [print(testing.printRule(x)) for x in otherSupportingRules]
 #   osr=csr, and diff=[]
 diff, msr, osr, cmr, csr = testing.getAndCounterfactuallyExplainConclusion(premise,pref2Theory[''], 'box')
 #
+# Counterfactual queries also have a compiled version, with the same answers
+compiledCounterfactuals = testing.compileCounterfactuals(pref2Theory[''])
+diff, msr, osr, cmr, csr = testing.getAndCounterfactuallyExplainConclusionCompiled(premise, compiledCounterfactuals, 'box')
+#
+# To get the counterfactual explanation for every other conclusion of the theory at once:
+#     outputs: msr and osr as above; a dictionary from each alternative conclusion to its diff, cmr and csr
+msr, osr, alternatives = testing.getAndCounterfactuallyExplainAllConclusions(premise, compiledCounterfactuals)
+#
 # What if we actually changed the premise as indicated, would the counterfactual conclusion hold?
 counterfactualPremise = testing.modifyPremise(premise, diff)
 maxSupportingRule, otherSupportingRules = testing.getAndExplainConclusion(counterfactualPremise, pref2Theory[''])
@@ -93,3 +107,10 @@ print("Replace\n\t(%s)\nwith\n\t(%s)\nask about:" % (testing.printRule(rule), te
 for e in askAbout:
     print("\t(%s)\n" % testing.printRule(e))
 
+#
+# When a theory is edited interactively, keep it as an editable theory: edits give the same askAbout as
+#   updateTheory, but only look at the affected rules, and the compiled indexes and cached explanations stay valid
+editableTheory = testing.makeEditableTheory(pref2Theory[''])
+maxSupportingRule, otherSupportingRules = testing.explainEditable(editableTheory, premise)
+askAbout = testing.updateEditableTheory(editableTheory, maxSupportingRule, (maxSupportingRule[0], maxSupportingRule[1]))
+diff, msr, osr, cmr, csr = testing.getAndCounterfactuallyExplainConclusionCompiled(premise, editableTheory["counterfactuals"], msr[1])
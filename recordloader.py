@@ -0,0 +1,117 @@
+import array
+import ast
+import hashlib
+import os
+import struct
+
+import artifact
+
+# Binary sidecar of a records file, all integers little endian:
+#   header: magic, format version, term count, record count, stream length, sha256 of the source file
+#   term table: u32 end offsets of each term, utf-8 bytes of all terms
+#   u32 stream of (record length, term ids...) per record
+MAGIC = b'HERORECS'
+VERSION = 1
+headerFormat = '<8sIIQQ32s'
+headerSize = struct.calcsize(headerFormat)
+
+loaded = {}
+
+def fileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def iterRecordLines(path):
+    with open(path) as infile:
+        for line in infile:
+            if line.strip():
+                yield ast.literal_eval(line)
+
+def encodeRecordFile(path):
+    terms = []
+    termIds = {}
+    stream = array.array('I')
+    count = 0
+    for r in iterRecordLines(path):
+        stream.append(len(r))
+        for t in r:
+            if t not in termIds:
+                termIds[t] = len(terms)
+                terms.append(t)
+            stream.append(termIds[t])
+        count = count + 1
+    return terms, stream, count
+
+def writeRecordCache(cachePath, digest, terms, stream, count):
+    encodedTerms = [t.encode('utf-8') for t in terms]
+    ends = []
+    end = 0
+    for t in encodedTerms:
+        end = end + len(t)
+        ends.append(end)
+    with open(cachePath + ".tmp", "wb") as outfile:
+        outfile.write(struct.pack(headerFormat, MAGIC, VERSION, len(terms), count, len(stream), digest))
+        outfile.write(artifact.u32Bytes(ends))
+        outfile.write(b''.join(encodedTerms))
+        outfile.write(artifact.u32Bytes(stream))
+    os.replace(cachePath + ".tmp", cachePath)
+
+def readRecordCache(cachePath, digest):
+    try:
+        with open(cachePath, 'rb') as infile:
+            magic, version, termCount, count, streamLength, cachedDigest = struct.unpack(headerFormat, infile.read(headerSize))
+            if (MAGIC != magic) or (VERSION != version) or (digest != cachedDigest):
+                return None
+            ends = artifact.u32Values(infile.read(4*termCount))
+            blob = infile.read(ends[-1] if termCount else 0)
+            stream = artifact.u32Values(infile.read(4*streamLength))
+    except (OSError, struct.error, ValueError):
+        return None
+    if (len(ends) != termCount) or (len(stream) != streamLength):
+        return None
+    terms = []
+    start = 0
+    for end in ends:
+        terms.append(blob[start:end].decode('utf-8'))
+        start = end
+    return terms, stream, count
+
+def loadEncodedRecords(path, cachePath=None, digest=None):
+    # returns the term table and one array of term ids per record
+    if None == cachePath:
+        cachePath = path + ".cache"
+    if None == digest:
+        digest = fileDigest(path)
+    cached = readRecordCache(cachePath, digest)
+    if None == cached:
+        cached = encodeRecordFile(path)
+        try:
+            writeRecordCache(cachePath, digest, *cached)
+        except OSError:
+            # the sidecar only saves parsing next time; a read only or full disk still gets the records
+            try:
+                os.remove(cachePath + ".tmp")
+            except OSError:
+                pass
+    terms, stream, count = cached
+    records = []
+    k = 0
+    for _ in range(count):
+        n = stream[k]
+        records.append(stream[k + 1:k + 1 + n])
+        k = k + 1 + n
+    return terms, records
+
+def loadRecords(path, cachePath=None):
+    # the records as lists of terms, which is what training and evaluation work on; the sidecar only saves the parse
+    # every occurrence of a term is the same string object; repeated calls in a process return the same list,
+    # shared by all callers, which must not modify it, until the file changes
+    key = (os.path.abspath(path), cachePath)
+    digest = fileDigest(path)
+    if (key not in loaded) or (digest != loaded[key][0]):
+        terms, records = loadEncodedRecords(path, cachePath=cachePath, digest=digest)
+        loaded[key] = (digest, [[terms[x] for x in r] for r in records])
+    return loaded[key][1]
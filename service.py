@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+
+import artifact
+import testing
+
+# Local query service. The theories of a training run are loaded once and queries come in over a TCP port or a
+# unix socket, one JSON object per line, each answered by one JSON line with the same "id":
+#   {"id": 1, "op": "explain", "prefix": "", "premise": [...]}
+#   {"id": 2, "op": "rank", "prefixes": ["", "color"], "premise": [...]}
+#   {"id": 3, "op": "exemplar", "prefix": "", "conclusion": "box"}
+#   {"id": 4, "op": "counterfactual", "prefix": "", "premise": [...], "conclusion": "box"}
+#       without "conclusion", every alternative conclusion is explained
+# Answers are {"id": ..., "result": ...} or {"id": ..., "error": "..."}; rules are [sorted antecedent, conclusion].
+# Concurrent queries are answered in micro-batches, explain and rank queries with one walk over each theory.
+# When the run file is replaced, e.g. by training.py, the new theories are loaded and swapped in between batches.
+
+def fileStamp(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def loadServiceState(path):
+    stamp = fileStamp(path)
+    data = artifact.loadRunData(path, records=False)
+    theories = testing.makePref2TheoryMap([t for t in data["theory"] if t])
+    return {"stamp": stamp, "theories": theories, "counterfactuals": {}, "cache": testing.makeQueryCache()}
+
+def theoryFor(state, prefix):
+    if prefix not in state["theories"]:
+        raise ValueError("no theory for prefix %s" % repr(prefix))
+    return state["theories"][prefix]
+
+def counterfactualsFor(state, prefix):
+    if prefix not in state["counterfactuals"]:
+        state["counterfactuals"][prefix] = testing.compileCounterfactuals(theoryFor(state, prefix))
+    return state["counterfactuals"][prefix]
+
+def encodeRule(rule):
+    if None == rule:
+        return None
+    return [sorted(rule[0]), rule[1]]
+
+def encodeExplanation(maxSupportingRule, otherSupportingRules):
+    return {"rule": encodeRule(maxSupportingRule), "others": [encodeRule(r) for r in otherSupportingRules]}
+
+def answerCounterfactual(state, query, premise):
+    compiledCF = counterfactualsFor(state, query["prefix"])
+    if None == testing.getAndExplainConclusionCompiled(premise, compiledCF[0])[0]:
+        raise ValueError("no rule applies to the premise")
+    if None == query.get("conclusion"):
+        msr, osr, alternatives = testing.getAndCounterfactuallyExplainAllConclusions(premise, compiledCF)
+        retq = encodeExplanation(msr, osr)
+        retq["alternatives"] = {c: {"diff": sorted(diff), "counterfactualRule": encodeRule(cmr), "counterfactualOthers": [encodeRule(r) for r in csr]} for c, (diff, cmr, csr) in alternatives.items()}
+        return retq
+    if query["conclusion"] not in compiledCF[1]:
+        raise ValueError("no rule concludes %s" % query["conclusion"])
+    diff, msr, osr, cmr, csr = testing.getAndCounterfactuallyExplainConclusionCompiled(premise, compiledCF, query["conclusion"])
+    retq = encodeExplanation(msr, osr)
+    retq.update({"diff": sorted(diff), "counterfactualRule": encodeRule(cmr), "counterfactualOthers": [encodeRule(r) for r in csr]})
+    return retq
+
+def answerBatch(state, queries):
+    answers = [None]*len(queries)
+    premises = [None]*len(queries)
+    explain = {}
+    rank = {}
+    for k, q in enumerate(queries):
+        try:
+            if not isinstance(q, dict):
+                raise ValueError("a query must be a JSON object")
+            op = q.get("op")
+            if op in ["explain", "rank", "counterfactual"]:
+                premises[k] = frozenset(q["premise"])
+            if "explain" == op:
+                theoryFor(state, q["prefix"])
+                explain.setdefault(q["prefix"], []).append(k)
+            elif "rank" == op:
+                for prefix in q["prefixes"]:
+                    theoryFor(state, prefix)
+                rank.setdefault(tuple(q["prefixes"]), []).append(k)
+            elif "exemplar" == op:
+                answers[k] = {"result": encodeExplanation(*testing.cachedGetDefaultExemplar(state["cache"], q["conclusion"], theoryFor(state, q["prefix"])))}
+            elif "counterfactual" == op:
+                answers[k] = {"result": answerCounterfactual(state, q, premises[k])}
+            else:
+                raise ValueError("unknown op %s" % repr(op))
+        except KeyError as e:
+            answers[k] = {"error": "missing field %s" % e}
+        except (TypeError, ValueError) as e:
+            answers[k] = {"error": str(e)}
+    for prefix, ks in explain.items():
+        explanations = testing.batchExplainConclusions([premises[k] for k in ks], theoryFor(state, prefix))
+        for k, (msr, osr) in zip(ks, explanations):
+            answers[k] = {"result": encodeExplanation(msr, osr)}
+    for prefixes, ks in rank.items():
+        rankings = testing.batchConclusionsRanking([premises[k] for k in ks], [theoryFor(state, p) for p in prefixes])
+        for k, ranking in zip(ks, rankings):
+            answers[k] = {"result": [list(x) for x in ranking]}
+    return answers
+
+async def batcher(service):
+    queue = service["queue"]
+    while True:
+        batch = [await queue.get()]
+        if 0 < service["batchWindow"]:
+            await asyncio.sleep(service["batchWindow"])
+        while (len(batch) < service["maxBatch"]) and (not queue.empty()):
+            batch.append(queue.get_nowait())
+        # the whole batch is answered from one state, even if a reload swaps it meanwhile
+        state = service["state"]
+        try:
+            answers = answerBatch(state, [q for q, _ in batch])
+        except Exception as e:
+            answers = [{"error": "internal error: %s" % e} for _ in batch]
+        for (_, future), a in zip(batch, answers):
+            if not future.done():
+                future.set_result(a)
+
+async def watchRun(service):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(service["reloadInterval"])
+        stamp = None
+        try:
+            stamp = fileStamp(service["path"])
+            if stamp in [service["state"]["stamp"], service.get("failedStamp")]:
+                continue
+            state = await loop.run_in_executor(None, loadServiceState, service["path"])
+        except Exception as e:
+            # keep serving the theories already loaded until the file changes again, whatever went wrong
+            service["failedStamp"] = stamp
+            print("Could not reload %s: %s" % (service["path"], e))
+            continue
+        service["state"] = state
+        print("Reloaded %s" % service["path"])
+
+async def handleConnection(service, reader, writer):
+    loop = asyncio.get_running_loop()
+    async def answer(line):
+        try:
+            q = json.loads(line)
+        except ValueError as e:
+            q = None
+            a = {"error": "bad JSON: %s" % e}
+        else:
+            future = loop.create_future()
+            await service["queue"].put((q, future))
+            a = await future
+        a["id"] = q.get("id") if isinstance(q, dict) else None
+        writer.write((json.dumps(a) + "\n").encode('utf-8'))
+        await writer.drain()
+    pending = set()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.ensure_future(answer(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(path, host="127.0.0.1", port=8765, unixPath=None, batchWindow=0.002, maxBatch=256, reloadInterval=1.0):
+    service = {"path": path, "state": loadServiceState(path), "queue": asyncio.Queue(), "batchWindow": batchWindow, "maxBatch": maxBatch, "reloadInterval": reloadInterval}
+    handler = lambda reader, writer: handleConnection(service, reader, writer)
+    if None != unixPath:
+        server = await asyncio.start_unix_server(handler, path=unixPath)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+    workers = [asyncio.ensure_future(batcher(service)), asyncio.ensure_future(watchRun(service))]
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for w in workers:
+            w.cancel()
+
+def askService(queries, host="127.0.0.1", port=8765, unixPath=None):
+    # blocking client: sends all queries on one connection and returns the answers in the order of the queries
+    if None != unixPath:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(unixPath)
+    else:
+        conn = socket.create_connection((host, port))
+    with conn:
+        conn.sendall(b''.join([(json.dumps(dict(q, id=k)) + "\n").encode('utf-8') for k, q in enumerate(queries)]))
+        conn.shutdown(socket.SHUT_WR)
+        answers = [None]*len(queries)
+        with conn.makefile('rb') as infile:
+            for line in infile:
+                a = json.loads(line)
+                answers[a.pop("id")] = a
+    return answers
+
+if "__main__" == __name__:
+    asyncio.run(serve(sys.argv[1], port=int(sys.argv[2]) if 2 < len(sys.argv) else 8765))
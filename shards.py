@@ -0,0 +1,127 @@
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+
+import recordloader
+import training
+
+# Out of core version of datasetFromRecords + splitDataset + prepConflictDataset.
+# Records are streamed in chunks; every chunk is counted into one shard file per quality prefix holding
+#   {premise: {conclusion: [count, first position]}}
+# where a position is (record index, fact index), i.e. the place the pair would have in datasetFromRecords.
+# Shards of one prefix are then merged on their own, so only one prefix needs to fit in memory at a time.
+# Keeping first positions makes the merged datasets identical, order included, to the in memory ones.
+
+def shardPath(shardDir, prefix, chunkIndex):
+    return os.path.join(shardDir, "%s.%d.shard" % (prefix, chunkIndex))
+
+def iterChunks(records, chunkSize):
+    chunk = []
+    for r in records:
+        chunk.append(r)
+        if chunkSize <= len(chunk):
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def countChunk(job):
+    shardDir, chunkIndex, start, chunk = job
+    counts = {}
+    vocabulary = set()
+    for j, r in enumerate(chunk):
+        vocabulary.update(r)
+        for k, d in enumerate(r):
+            prefix = training.qualityPrefix(d)
+            if prefix not in counts:
+                counts[prefix] = {}
+            premise = frozenset(r[:k] + r[k+1:])
+            if premise not in counts[prefix]:
+                counts[prefix][premise] = {}
+            if d not in counts[prefix][premise]:
+                counts[prefix][premise][d] = [0, (start + j, k)]
+            counts[prefix][premise][d][0] = counts[prefix][premise][d][0] + 1
+    for prefix, premises in counts.items():
+        with open(shardPath(shardDir, prefix, chunkIndex), "wb") as outfile:
+            pickle.dump(premises, outfile)
+    return list(counts.keys()), vocabulary
+
+def mergeShards(job):
+    shardDir, prefix, chunkIndices = job
+    merged = {}
+    for chunkIndex in chunkIndices:
+        with open(shardPath(shardDir, prefix, chunkIndex), "rb") as infile:
+            premises = pickle.load(infile)
+        for premise, conclusions in premises.items():
+            if premise not in merged:
+                merged[premise] = {}
+            for d, (count, first) in conclusions.items():
+                # chunks arrive in order, so the first position seen is the earliest one
+                if d not in merged[premise]:
+                    merged[premise][d] = [0, first]
+                merged[premise][d][0] = merged[premise][d][0] + count
+    retq = []
+    for premise, conclusions in merged.items():
+        ordered = sorted(conclusions.items(), key=lambda x: x[1][1])
+        argMax = training.argMaxUnique({d: c[0] for d, c in ordered})
+        if None != argMax:
+            retq.append((ordered[0][1][1], premise, argMax))
+    retq.sort(key=lambda x: x[0])
+    return [(premise, conclusion) for _, premise, conclusion in retq]
+
+def countShards(records, shardDir, chunkSize=10000, processes=None):
+    # returns, per prefix, the chunks that have a shard for it, and the vocabulary of all records
+    # at most one chunk per worker is held in memory at any time
+    shardsOf = {}
+    vocabulary = set()
+    pool = multiprocessing.Pool(processes) if None != processes else None
+    wave = []
+    start = 0
+    def flush(wave):
+        results = pool.map(countChunk, wave) if None != pool else [countChunk(job) for job in wave]
+        for job, (prefixes, terms) in zip(wave, results):
+            vocabulary.update(terms)
+            for prefix in prefixes:
+                if prefix not in shardsOf:
+                    shardsOf[prefix] = []
+                shardsOf[prefix].append(job[1])
+    try:
+        for chunkIndex, chunk in enumerate(iterChunks(records, chunkSize)):
+            wave.append((shardDir, chunkIndex, start, chunk))
+            start = start + len(chunk)
+            if len(wave) >= (processes or 1):
+                flush(wave)
+                wave = []
+        if wave:
+            flush(wave)
+    finally:
+        if None != pool:
+            pool.close()
+            pool.join()
+    return shardsOf, vocabulary
+
+def shardedDatasets(records, mutexsets, shardDir=None, chunkSize=10000, processes=None):
+    # conflict resolved datasets aligned with mutexsets, as HeRO builds them, plus the vocabulary
+    ownDir = None == shardDir
+    if ownDir:
+        shardDir = tempfile.mkdtemp(prefix="heroshards")
+    try:
+        shardsOf, vocabulary = countShards(records, shardDir, chunkSize=chunkSize, processes=processes)
+        jobs = [(shardDir, training.qualityPrefix(list(ms)[0]), shardsOf.get(training.qualityPrefix(list(ms)[0]), [])) for ms in mutexsets]
+        if None == processes:
+            datasets = [mergeShards(job) for job in jobs]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                datasets = pool.map(mergeShards, jobs)
+    finally:
+        if ownDir:
+            shutil.rmtree(shardDir, ignore_errors=True)
+    return datasets, vocabulary
+
+def trainFromRecordFile(path, mutexsets, restrictions=None, processes=None, chunkSize=10000, shardDir=None):
+    datasets, vocabulary = shardedDatasets(recordloader.iterRecordLines(path), mutexsets, shardDir=shardDir, chunkSize=chunkSize, processes=processes)
+    # the datasets are already conflict resolved, which prepConflictDataset leaves unchanged
+    dataset = [pair for ds in datasets for pair in ds]
+    return training.multiHeRO(dataset, mutexsets, sorted(vocabulary), restrictions=restrictions, processes=processes)
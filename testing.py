@@ -1,20 +1,69 @@
+import artifact
+import bisect
+import collections
 import os
 import sys
 import time
-import pickle
 import functools
+import itertools
+import multiprocessing
+import weakref
 
 def qualityPrefix(s):
     if '_' in s:
         return s[:s.find('_')]
     return ''
 
-def getConclusionRankingInternal(premise, theory):
-    retq = []
+def iterConclusionRanking(premise, theory):
+    # the distinct conclusions of the rules applicable to the premise, in descending priority, as they are found
+    seen = set()
     for r in reversed(theory):
-        if (not r[0].difference(premise)) and (not r[1] in retq):
-            retq.append(r[1])
-    return retq
+        if (r[1] not in seen) and (not r[0].difference(premise)):
+            seen.add(r[1])
+            yield r[1]
+
+def getConclusionRankingInternal(premise, theory):
+    return list(iterConclusionRanking(premise, theory))
+
+def compileTheory(theory):
+    # every rule is filed under its antecedent term used by the fewest rules; a rule can only apply when
+    # that term is in the premise, and the subset test in iterApplicableRules settles the rest
+    termCounts = {}
+    for r in theory:
+        for t in r[0]:
+            termCounts[t] = termCounts.get(t, 0) + 1
+    termRules = {}
+    emptyRules = 0
+    for k, r in enumerate(theory):
+        if not r[0]:
+            emptyRules |= 1 << k
+            continue
+        key = min(sorted(r[0]), key=termCounts.get)
+        termRules[key] = termRules.get(key, 0) | (1 << k)
+    return theory, termRules, emptyRules
+
+def iterApplicableRules(premise, compiled):
+    theory, termRules, emptyRules = compiled
+    if not isinstance(premise, (set, frozenset)):
+        premise = frozenset(premise)
+    candidates = emptyRules
+    for t in premise:
+        candidates |= termRules.get(t, 0)
+    while candidates:
+        k = candidates.bit_length() - 1
+        candidates ^= 1 << k
+        if theory[k][0] <= premise:
+            yield theory[k]
+
+def iterConclusionRankingCompiled(premise, compiled):
+    seen = set()
+    for r in iterApplicableRules(premise, compiled):
+        if r[1] not in seen:
+            seen.add(r[1])
+            yield r[1]
+
+def getConclusionRankingCompiled(premise, compiled):
+    return list(iterConclusionRankingCompiled(premise, compiled))
 
 def getConclusionsRanking(premise, theories):
     if not theories:
@@ -24,20 +73,37 @@ def getConclusionsRanking(premise, theories):
     conclusions = [x[:minlen] for x in conclusions]
     return [tuple([x[k] for x in conclusions]) for k, _ in enumerate(conclusions[0])]
 
+def iterConclusionsRanking(premise, theories, compiled=False):
+    # lazy getConclusionsRanking: position k combines the k-th conclusion of every theory, until one runs out;
+    # with compiled=True the theories are compileTheory results
+    if not theories:
+        return
+    iterRanking = iterConclusionRankingCompiled if compiled else iterConclusionRanking
+    yield from zip(*[iterRanking(premise, t) for t in theories])
+
+def topConclusions(premise, theories, k, compiled=False):
+    return list(itertools.islice(iterConclusionsRanking(premise, theories, compiled), k))
+
+def goldRank(premise, correctConclusions, theories, limit=None, compiled=False):
+    # position of correctConclusions in getConclusionsRanking, None if it is not among the first limit positions
+    for k, conclusions in enumerate(iterConclusionsRanking(premise, theories, compiled)):
+        if (None != limit) and (limit <= k):
+            break
+        if correctConclusions == conclusions:
+            return k
+    return None
+
 def evaluateEntry(premise, correctConclusions, theories, atK):
-    conclusions = getConclusionsRanking(premise, theories)
-    if not conclusions:
+    rank = goldRank(premise, correctConclusions, theories)
+    if None == rank:
         return 0, 0.0, 0
     accInc = 0
-    mrrInc = 0.0
     hitsInc = 0
-    if correctConclusions == conclusions[0]:
+    if 0 == rank:
         accInc = 1
-    if correctConclusions in conclusions:
-        mrrInc = 1.0/(1.0 + conclusions.index(correctConclusions))
-        if correctConclusions in conclusions[:atK]:
-            hitsInc = 1
-    return accInc, mrrInc, hitsInc
+    if rank < atK:
+        hitsInc = 1
+    return accInc, 1.0/(1.0 + rank), hitsInc
 
 def makePairs(records, premisePrefs, conclusionPrefs):
     concsPrefS = set(conclusionPrefs)
@@ -85,18 +151,180 @@ def makeSplitEntries(records, splitRatio, premisePrefs, conclusionPrefs, theorie
     pairsTestFair = makeFairTest(pairsTestRaw, pairsTrainConsistent)
     return list(pairsTrainConsistent.items()), pairsTestFair
 
-def testTheories(records, splitRatio, premisePrefs, conclusionPrefs, theories, atK):
-    _, pairsTest = makeSplitEntries(records, splitRatio, premisePrefs, conclusionPrefs, theories)
+def bitsFromIds(ids):
+    buf = bytearray()
+    for k in ids:
+        byte = k >> 3
+        if len(buf) <= byte:
+            buf.extend(bytes(1 + byte - len(buf)))
+        buf[byte] |= 1 << (k & 7)
+    return int.from_bytes(buf, 'little')
+
+def iterBits(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def batchGoldRanks(termTests, allTests, golds, theory):
+    # Walks the theory in priority order once for all tests. Each rule's applicability is a bitset over tests;
+    # the number of distinct conclusions seen so far is a bit-sliced counter, one bitset per binary digit.
+    goldBits = {}
+    for k, g in enumerate(golds):
+        goldBits[g] = goldBits.get(g, 0) | (1 << k)
+    seen = {}
+    counter = []
+    found = 0
+    rankPlanes = []
+    for r in reversed(theory):
+        applicable = allTests
+        for t in r[0]:
+            applicable &= termTests.get(t, 0)
+        new = applicable & ~seen.get(r[1], 0)
+        if not new:
+            continue
+        seen[r[1]] = seen.get(r[1], 0) | new
+        hit = new & goldBits.get(r[1], 0)
+        if hit:
+            found |= hit
+            rankPlanes = rankPlanes + [0]*(len(counter) - len(rankPlanes))
+            for p, plane in enumerate(counter):
+                rankPlanes[p] |= plane & hit
+        carry = new
+        for p in range(len(counter)):
+            counter[p], carry = counter[p] ^ carry, counter[p] & carry
+            if not carry:
+                break
+        if carry:
+            counter.append(carry)
+    ranks = [None]*len(golds)
+    for k in iterBits(found):
+        ranks[k] = 0
+    for p, plane in enumerate(rankPlanes):
+        for k in iterBits(plane):
+            ranks[k] = ranks[k] + (1 << p)
+    return ranks
+
+def termTestBits(premises):
+    termIds = {}
+    for k, premise in enumerate(premises):
+        for e in premise:
+            if e not in termIds:
+                termIds[e] = []
+            termIds[e].append(k)
+    termTests = {e: bitsFromIds(ids) for e, ids in termIds.items()}
+    return termTests, (1 << len(premises)) - 1
+
+def batchExplainConclusions(premises, theory):
+    # getAndExplainConclusion for every premise, in one walk over the theory; tests stay open until a rule
+    # with another conclusion than their maximal one applies
+    termTests, openTests = termTestBits(premises)
+    maxSupportingRules = [None]*len(premises)
+    otherSupportingRules = [[] for _ in premises]
+    started = 0
+    startedWith = {}
+    for r in reversed(theory):
+        if not openTests:
+            break
+        applicable = openTests
+        for t in r[0]:
+            applicable &= termTests.get(t, 0)
+        if not applicable:
+            continue
+        new = applicable & ~started
+        for k in iterBits(new):
+            maxSupportingRules[k] = r
+        started |= new
+        startedWith[r[1]] = startedWith.get(r[1], 0) | new
+        same = applicable & ~new & startedWith[r[1]]
+        for k in iterBits(same):
+            otherSupportingRules[k].append(r)
+        openTests &= ~(applicable & ~new & ~same)
+    return list(zip(maxSupportingRules, otherSupportingRules))
+
+def batchConclusionsRanking(premises, theories):
+    # getConclusionsRanking for every premise, walking each theory once
+    if not theories:
+        return [[] for _ in premises]
+    termTests, allTests = termTestBits(premises)
+    rankings = []
+    for theory in theories:
+        ranking = [[] for _ in premises]
+        seen = {}
+        for r in reversed(theory):
+            applicable = allTests
+            for t in r[0]:
+                applicable &= termTests.get(t, 0)
+            new = applicable & ~seen.get(r[1], 0)
+            if not new:
+                continue
+            seen[r[1]] = seen.get(r[1], 0) | new
+            for k in iterBits(new):
+                ranking[k].append(r[1])
+        rankings.append(ranking)
+    retq = []
+    for k in range(len(premises)):
+        conclusions = [x[k] for x in rankings]
+        minlen = min([len(x) for x in conclusions])
+        retq.append([tuple([x[j] for x in conclusions]) for j in range(minlen)])
+    return retq
+
+def evaluateBatch(pairsTest, theories, atK):
+    termTests, allTests = termTestBits([t[0] for t in pairsTest])
+    ranks = [batchGoldRanks(termTests, allTests, [t[1][j] for t in pairsTest], theory) for j, theory in enumerate(theories)]
     acc = 0
     mrr = 0.0
     hits = 0
+    for k in range(len(pairsTest)):
+        if not theories:
+            continue
+        rank = ranks[0][k]
+        if (None == rank) or any([rank != x[k] for x in ranks[1:]]):
+            continue
+        if 0 == rank:
+            acc = acc + 1
+        mrr = mrr + 1.0/(1.0 + rank)
+        if rank < atK:
+            hits = hits + 1
+    return acc, mrr, hits
+
+def makePrefixRecords(records):
+    retq = []
+    for x in records:
+        prefs = {}
+        for y in x:
+            pref = qualityPrefix(y)
+            if pref not in prefs:
+                prefs[pref] = []
+            prefs[pref].append(y)
+        retq.append(prefs)
+    return retq
+
+def makePairsFromPrefixRecords(prefixRecords, premisePrefs, conclusionPrefs):
+    retq = []
+    for r in prefixRecords:
+        if [pref for pref in conclusionPrefs if pref not in r]:
+            continue
+        premise = frozenset([y for pref in set(premisePrefs) if pref in r for y in r[pref]])
+        retq.append((premise, tuple([r[pref][-1] for pref in conclusionPrefs])))
+    return retq
+
+def makeSplitEntriesCached(prefixRecords, splitRatio, premisePrefs, conclusionPrefs, cache):
+    key = (splitRatio, tuple(premisePrefs), tuple(conclusionPrefs))
+    if key not in cache:
+        cut = int(splitRatio*len(prefixRecords))
+        pairsTrainRaw = makePairsFromPrefixRecords(prefixRecords[:cut], premisePrefs, conclusionPrefs)
+        pairsTestRaw = makePairsFromPrefixRecords(prefixRecords[cut:], premisePrefs, conclusionPrefs)
+        pairsTrainConsistent = makeConsistentTraining(pairsTrainRaw)
+        pairsTestFair = makeFairTest(pairsTestRaw, pairsTrainConsistent)
+        cache[key] = (list(pairsTrainConsistent.items()), pairsTestFair)
+    return cache[key]
+
+def testTheories(records, splitRatio, premisePrefs, conclusionPrefs, theories, atK):
+    _, pairsTest = makeSplitEntries(records, splitRatio, premisePrefs, conclusionPrefs, theories)
     n = len(pairsTest)
     startT = time.perf_counter()
-    for t in pairsTest:
-        accInc, mrrInc, hitsInc = evaluateEntry(t[0], t[1], theories, atK)
-        acc = acc + accInc
-        mrr = mrr + mrrInc
-        hits = hits + hitsInc
+    acc, mrr, hits = evaluateBatch(pairsTest, theories, atK)
     endT = time.perf_counter()
     return 100*acc/n, 100*mrr/n, 100*hits/n, endT-startT
 
@@ -105,35 +333,79 @@ allPrefixes = ['', 'material', 'color', 'transparency', 'dimension', 'physical',
 def allButPrefix(pref):
     return [x for x in allPrefixes if x != pref]
 
-def runTestInternal(pathTemplate, splitRatio, testCaption):
+def evaluationTasks():
     def qName(pref):
         if '' == pref:
             return 'class'
         return pref
-    def guessingTask(taskName, premisePrefs, conclusionPrefs):
-        results = [testTheories(x['records'], 0.7, premisePrefs, conclusionPrefs, [x['theory'][prefix2Idx[pref]] for pref in conclusionPrefs], 3) for x in data]
-        guessResults = [sum([x[0] for x in results])/len(data), sum([x[1] for x in results])/len(data), sum([x[2] for x in results])/len(data), sum([x[3] for x in results])]
-        print("%s results (acc, mrr, hits@3): %3.02f %3.02f %3.02f" % (taskName, guessResults[0], guessResults[1], guessResults[2]))
-    print(testCaption)
-    data = []
-    for k in range(10):
-        with open(pathTemplate % (splitRatio, k), 'rb') as outfile:
-            data.append(pickle.load(outfile))
-    prefix2Idx = {qualityPrefix(list(x)[0]): k for k, x in enumerate(data[0]['mutexsets'])}
-    basicResults = {}
-    print("Basic results for guessing a quality from all others:")
-    for pref in allPrefixes:
-        results = [testTheories(x['records'], 0.7, allButPrefix(pref), [pref], [x['theory'][prefix2Idx[pref]]], 3) for x in data]
-        basicResults[pref] = [sum([x[0] for x in results])/len(data), sum([x[1] for x in results])/len(data), sum([x[2] for x in results])/len(data), sum([x[3] for x in results])]
-        print("\tBasic test for quality '%s' (acc mrr hits@3 | time): %3.02f %3.02f %3.02f | %3.02f" % (qName(pref), basicResults[0], basicResults[1], basicResults[2]), basicResults[pref])
-    print("Total time for basic tests: %f" % sum([x[3] for x in basicResults]))
-    guessingTask('Guess-Room', ['', 'cleanliness', 'temperature'], ['room'])
-    guessingTask('Guess-Place', ['', 'cleanliness', 'temperature', 'room'], ['place'])
-    guessingTask('Guess-Fullness', ['', 'cleanliness', 'temperature', 'room', 'place'], ['fullness'])
-
-def runTest():
-    runTestInternal("no_bias_log_%0.02f_%d.log", 0.7, "Running tests for NO BIAS HeRO search")
-    runTestInternal("kn_bias_log_%0.02f_%d.log", 0.7, "Running tests for KNOWLEDGE-BASED BIAS HeRO search")
+    tasks = [("Basic test for quality '%s'" % qName(pref), allButPrefix(pref), [pref]) for pref in allPrefixes]
+    tasks.append(('Guess-Room', ['', 'cleanliness', 'temperature'], ['room']))
+    tasks.append(('Guess-Place', ['', 'cleanliness', 'temperature', 'room'], ['place']))
+    tasks.append(('Guess-Fullness', ['', 'cleanliness', 'temperature', 'room', 'place'], ['fullness']))
+    return tasks
+
+def evaluationWorker(job):
+    # all runs in a job were trained on the same shuffled records, so they share every split
+    records, runs, tasks, splitRatio, atK = job
+    prefixRecords = makePrefixRecords(records)
+    cache = {}
+    results = []
+    for runKey, theories, mutexsets in runs:
+        prefix2Idx = {qualityPrefix(list(x)[0]): k for k, x in enumerate(mutexsets)}
+        for taskName, premisePrefs, conclusionPrefs in tasks:
+            _, pairsTest = makeSplitEntriesCached(prefixRecords, splitRatio, premisePrefs, conclusionPrefs, cache)
+            n = len(pairsTest)
+            startT = time.perf_counter()
+            acc, mrr, hits = evaluateBatch(pairsTest, [theories[prefix2Idx[pref]] for pref in conclusionPrefs], atK)
+            endT = time.perf_counter()
+            results.append((runKey, taskName, (100*acc/n, 100*mrr/n, 100*hits/n, endT-startT)))
+    return results
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q*len(ordered)))]
+
+def runEvaluation(configs, splitRatio, runCount=10, atK=3, processes=None):
+    groups = {}
+    for pathTemplate, _ in configs:
+        for k in range(runCount):
+            data = artifact.loadRunData(pathTemplate % (splitRatio, k))
+            key = tuple([tuple(x) for x in data['records']])
+            if key not in groups:
+                groups[key] = (data['records'], [])
+            groups[key][1].append(((pathTemplate, k), data['theory'], data['mutexsets']))
+    tasks = evaluationTasks()
+    jobs = [(records, runs, tasks, splitRatio, atK) for records, runs in groups.values()]
+    results = {}
+    def collect(batches):
+        for batch in batches:
+            for (pathTemplate, _), taskName, result in batch:
+                key = (pathTemplate, taskName)
+                if key not in results:
+                    results[key] = []
+                results[key].append(result)
+    if None == processes:
+        collect(map(evaluationWorker, jobs))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            collect(pool.imap(evaluationWorker, jobs))
+    for pathTemplate, testCaption in configs:
+        print(testCaption)
+        totalTime = 0.0
+        for taskName, _, _ in tasks:
+            taskResults = results[(pathTemplate, taskName)]
+            times = [x[3] for x in taskResults]
+            means = [sum([x[i] for x in taskResults])/len(taskResults) for i in range(3)]
+            totalTime = totalTime + sum(times)
+            print("\t%s (acc mrr hits@%d | time p50 p90 max): %3.02f %3.02f %3.02f | %f %f %f" % (taskName, atK, means[0], means[1], means[2], percentile(times, 0.5), percentile(times, 0.9), max(times)))
+        print("Total evaluation time: %f" % totalTime)
+    return results
+
+def runTestInternal(pathTemplate, splitRatio, testCaption, processes=None):
+    return runEvaluation([(pathTemplate, testCaption)], splitRatio, processes=processes)
+
+def runTest(processes=None):
+    runEvaluation([("no_bias_log_%0.02f_%d.log", "Running tests for NO BIAS HeRO search"), ("kn_bias_log_%0.02f_%d.log", "Running tests for KNOWLEDGE-BASED BIAS HeRO search")], 0.7, processes=processes)
 
 def getPrefix(p):
     idx = p.find('_')
@@ -171,6 +443,18 @@ def getAndExplainConclusion(premise, theory):
             else:
                 break
     return maxSupportingRule, otherSupportingRules
+
+def getAndExplainConclusionCompiled(premise, compiled):
+    maxSupportingRule = None
+    otherSupportingRules = []
+    for r in iterApplicableRules(premise, compiled):
+        if maxSupportingRule is None:
+            maxSupportingRule = r
+        elif maxSupportingRule[1] == r[1]:
+            otherSupportingRules.append(r)
+        else:
+            break
+    return maxSupportingRule, otherSupportingRules
     
 def modifyPremise(premise, diff):
     retq = set(premise)
@@ -197,52 +481,57 @@ def modifyPremise(premise, diff):
                 prefs[mset] = e
     return frozenset(retq)
 
-def getAndCounterfactuallyExplainConclusion(premise, theory, counterfactualConclusion):
-    def setPremiseForRule(premise, rule):
-        diff = set()
-        newPremise = set(premise)
-        prefs = {getPrefix(x): x for x in newPremise}
-        for e in rule[0]:
-            if e not in premise:
-                mset = getPrefix(e)
-                if mset in prefs:
-                    newPremise.remove(prefs[mset])
-                newPremise.add(e)
-                prefs[mset] = e
-                diff.add(e)
-        return diff, newPremise
-    def updatePremise(diff, premise, makeTrue=None, makeFalse=None):
-        diff = set(diff)
-        newPremise = set(premise)
-        prefs = {getPrefix(x): x for x in newPremise}
-        if makeTrue is None:
-            makeTrue = []
-        if makeFalse is None:
-            makeFalse = []
-        for p in makeTrue:
-            mset = getPrefix(p)
-            if (mset in prefs) and (p not in newPremise):
-                newPremise.remove(prefs[mset])
-                diff.add(p)
-                newPremise.add(p)
-            else:
-                diff.add(p)
-                newPremise.add(p)
-            prefs[mset] = p
-        for p in makeFalse:
-            mset = getPrefix(p)
-            np = '-'+p
+def premisePrefs(premise):
+    return {getPrefix(x): x for x in set(premise)}
+
+def setPremiseForRule(premise, rule, prefs=None):
+    diff = set()
+    newPremise = set(premise)
+    prefs = dict(prefs) if None != prefs else premisePrefs(newPremise)
+    for e in rule[0]:
+        if e not in premise:
+            mset = getPrefix(e)
             if mset in prefs:
-                if p in newPremise:
-                    newPremise.remove(p)
-                    diff.add(np)
-                    newPremise.add(np)
-                    prefs[mset] = np
-            else:
+                newPremise.remove(prefs[mset])
+            newPremise.add(e)
+            prefs[mset] = e
+            diff.add(e)
+    return diff, newPremise
+
+def updatePremise(diff, premise, makeTrue=None, makeFalse=None):
+    diff = set(diff)
+    newPremise = set(premise)
+    prefs = {getPrefix(x): x for x in newPremise}
+    if makeTrue is None:
+        makeTrue = []
+    if makeFalse is None:
+        makeFalse = []
+    for p in makeTrue:
+        mset = getPrefix(p)
+        if (mset in prefs) and (p not in newPremise):
+            newPremise.remove(prefs[mset])
+            diff.add(p)
+            newPremise.add(p)
+        else:
+            diff.add(p)
+            newPremise.add(p)
+        prefs[mset] = p
+    for p in makeFalse:
+        mset = getPrefix(p)
+        np = '-'+p
+        if mset in prefs:
+            if p in newPremise:
+                newPremise.remove(p)
                 diff.add(np)
                 newPremise.add(np)
                 prefs[mset] = np
-        return diff, newPremise
+        else:
+            diff.add(np)
+            newPremise.add(np)
+            prefs[mset] = np
+    return diff, newPremise
+
+def getAndCounterfactuallyExplainConclusion(premise, theory, counterfactualConclusion):
     def makeItWork(premise, rule, ruleIdx, theory):
         diff, newPremise = setPremiseForRule(premise, rule)
         for r in theory[ruleIdx+1:]:
@@ -263,6 +552,96 @@ def getAndCounterfactuallyExplainConclusion(premise, theory, counterfactualConcl
     maxCounterfactualRule, otherCounterfactualRules = getAndExplainConclusion(counterfactualPremise, theory)
     return answer, maxSupportingRule, otherSupportingRules, maxCounterfactualRule, otherCounterfactualRules
 
+def compileCounterfactuals(theory):
+    # On top of compileTheory: the rules of every conclusion, as indices and as a bitset. The possible defeaters
+    # of rule k are the rules above k outside the bitset of its conclusion. Rules with a negated antecedent term
+    # are kept apart, since makeItWork can make them applicable by adding negations to the premise.
+    conclusionRules = {}
+    conclusionBits = {}
+    negatedRules = 0
+    for k, r in enumerate(theory):
+        if r[1] not in conclusionRules:
+            conclusionRules[r[1]] = []
+            conclusionBits[r[1]] = 0
+        conclusionRules[r[1]].append(k)
+        conclusionBits[r[1]] |= 1 << k
+        if any(('-' == t[:1]) for t in r[0]):
+            negatedRules |= 1 << k
+    return compileTheory(theory), conclusionRules, conclusionBits, negatedRules
+
+def premiseCandidates(premise, compiled):
+    # rules that may apply to the premise, a superset that iterApplicableRules narrows down with subset tests
+    theory, termRules, emptyRules = compiled
+    retq = emptyRules
+    for t in premise:
+        retq |= termRules.get(t, 0)
+    return retq
+
+def makeItWorkCompiled(premise, k, compiledCF, candidates=None, prefs=None):
+    compiled, conclusionRules, conclusionBits, negatedRules = compiledCF
+    theory = compiled[0]
+    rule = theory[k]
+    diff, newPremise = setPremiseForRule(premise, rule, prefs)
+    # updatePremise only ever turns positive terms into negations, so a defeater without negated terms
+    # can only apply if it already applies right after setPremiseForRule; newPremise is within premise | rule[0],
+    # so the candidates of the premise, when given, only need those of the rule added
+    if None == candidates:
+        candidates = premiseCandidates(newPremise, compiled)
+    else:
+        candidates |= premiseCandidates(rule[0], compiled)
+    candidates = (candidates | negatedRules) & ~((2 << k) - 1) & ~conclusionBits[rule[1]]
+    for j in iterBits(candidates):
+        r = theory[j]
+        if not r[0].difference(newPremise):
+            diff, newPremise = updatePremise(diff, newPremise, makeTrue=None, makeFalse=r[0].difference(rule))
+    return diff, newPremise
+
+def minimalCounterfactual(premise, ruleIdxs, compiledCF, candidates=None, prefs=None):
+    # a candidate's diff contains every antecedent term missing from the premise, so that count is a lower bound;
+    # trying candidates by (bound, index) allows stopping at the first one that cannot beat the answer
+    # while still preferring the lowest index among the shortest diffs, like the linear version
+    theory = compiledCF[0][0]
+    ranked = sorted((len(theory[k][0].difference(premise)), k) for k in ruleIdxs)
+    answer = None
+    answerIdx = None
+    counterfactualPremise = None
+    for bound, k in ranked:
+        if (answer is not None) and ((len(answer), answerIdx) < (bound, k)):
+            break
+        candidate, newPremise = makeItWorkCompiled(premise, k, compiledCF, candidates, prefs)
+        if (answer is None) or ((len(candidate), k) < (len(answer), answerIdx)):
+            answer = candidate
+            answerIdx = k
+            counterfactualPremise = newPremise
+    return answer, counterfactualPremise
+
+def getAndCounterfactuallyExplainConclusionCompiled(premise, compiledCF, counterfactualConclusion):
+    compiled, conclusionRules, conclusionBits, negatedRules = compiledCF
+    maxSupportingRule, otherSupportingRules = getAndExplainConclusionCompiled(premise, compiled)
+    if maxSupportingRule[1] == counterfactualConclusion:
+        return [], maxSupportingRule, otherSupportingRules, maxSupportingRule, otherSupportingRules
+    answer, counterfactualPremise = minimalCounterfactual(premise, conclusionRules.get(counterfactualConclusion, []), compiledCF)
+    maxCounterfactualRule, otherCounterfactualRules = getAndExplainConclusionCompiled(counterfactualPremise, compiled)
+    return answer, maxSupportingRule, otherSupportingRules, maxCounterfactualRule, otherCounterfactualRules
+
+def getAndCounterfactuallyExplainAllConclusions(premise, compiledCF):
+    # one pass for every conclusion of the theory other than the one it gives for the premise;
+    # returns the explanation of the premise and {conclusion: (diff, maxCounterfactualRule, otherCounterfactualRules)}
+    # with the same answers as one getAndCounterfactuallyExplainConclusion call per conclusion
+    compiled, conclusionRules, conclusionBits, negatedRules = compiledCF
+    premise = frozenset(premise)
+    maxSupportingRule, otherSupportingRules = getAndExplainConclusionCompiled(premise, compiled)
+    candidates = premiseCandidates(premise, compiled)
+    prefs = premisePrefs(premise)
+    alternatives = {}
+    for conclusion, ruleIdxs in conclusionRules.items():
+        if maxSupportingRule[1] == conclusion:
+            continue
+        answer, counterfactualPremise = minimalCounterfactual(premise, ruleIdxs, compiledCF, candidates, prefs)
+        maxCounterfactualRule, otherCounterfactualRules = getAndExplainConclusionCompiled(counterfactualPremise, compiled)
+        alternatives[conclusion] = (answer, maxCounterfactualRule, otherCounterfactualRules)
+    return maxSupportingRule, otherSupportingRules, alternatives
+
 def getDefaultExemplar(conclusion, theory):
     supportingRules = []
     for r in theory:
@@ -277,12 +656,176 @@ def updateTheory(oldRule, theory, newRule):
         return None
     k = theory.index(oldRule)
     theory[k] = newRule
+    theoryEdited(theory)
     askAbout = []
     for r in theory[k+1:]:
         if (not oldRule[0].difference(r[0])) or (not newRule[0].difference(r[0])):
             askAbout.append(r)
     return askAbout
 
+def makeEditableTheory(theory):
+    # A theory kept together with the indexes that edits would otherwise invalidate. The theory list is used, and
+    # edited, in place. "compiled" and "counterfactuals" are what compileTheory and compileCounterfactuals return,
+    # kept up to date by updateEditableTheory; the rule a compiled index is filed under is kept in "ruleKeys".
+    editable = {"theory": theory, "positions": {}, "antecedentBits": {}, "termCounts": {}, "ruleKeys": [None]*len(theory), "explanations": {}, "premisesWithTerm": {}}
+    for k, r in enumerate(theory):
+        editable["positions"].setdefault(r, []).append(k)
+        for t in r[0]:
+            editable["antecedentBits"][t] = editable["antecedentBits"].get(t, 0) | (1 << k)
+    compiledCF = compileCounterfactuals(theory)
+    compiled = compiledCF[0]
+    for t, bits in compiled[1].items():
+        for k in iterBits(bits):
+            editable["ruleKeys"][k] = t
+    for r in theory:
+        for t in r[0]:
+            editable["termCounts"][t] = editable["termCounts"].get(t, 0) + 1
+    editable["compiled"] = compiled
+    editable["counterfactuals"] = compiledCF
+    return editable
+
+def supersetRules(editable, antecedent):
+    # bitset of the rules whose antecedent contains the given one
+    retq = (1 << len(editable["theory"])) - 1
+    for t in antecedent:
+        retq &= editable["antecedentBits"].get(t, 0)
+    return retq
+
+def cachedPremises(editable, antecedent):
+    # cached premises that contain the antecedent, i.e. the ones a rule with this antecedent applies to
+    if not antecedent:
+        return set(editable["explanations"].keys())
+    withTerm = [editable["premisesWithTerm"].get(t, set()) for t in antecedent]
+    withTerm.sort(key=len)
+    return withTerm[0].intersection(*withTerm[1:])
+
+def explainEditable(editable, premise):
+    premise = frozenset(premise)
+    explanations = editable["explanations"]
+    if premise not in explanations:
+        explanations[premise] = getAndExplainConclusionCompiled(premise, editable["compiled"])
+        for t in premise:
+            editable["premisesWithTerm"].setdefault(t, set()).add(premise)
+    return explanations[premise]
+
+def updateEditableTheory(editable, oldRule, newRule):
+    # same edit and askAbout as updateTheory
+    theory = editable["theory"]
+    positions = editable["positions"]
+    if not positions.get(oldRule):
+        return None
+    k = positions[oldRule].pop(0)
+    if not positions[oldRule]:
+        positions.pop(oldRule)
+    bisect.insort(positions.setdefault(newRule, []), k)
+    theory[k] = newRule
+    askAbout = (supersetRules(editable, oldRule[0]) | supersetRules(editable, newRule[0])) & ~((2 << k) - 1)
+    # only the explanations of premises the old or the new rule applies to can change
+    for premise in cachedPremises(editable, oldRule[0]) | cachedPremises(editable, newRule[0]):
+        editable["explanations"].pop(premise)
+        for t in premise:
+            editable["premisesWithTerm"][t].discard(premise)
+    antecedentBits = editable["antecedentBits"]
+    termCounts = editable["termCounts"]
+    for t in oldRule[0]:
+        antecedentBits[t] &= ~(1 << k)
+        termCounts[t] = termCounts[t] - 1
+    for t in newRule[0]:
+        antecedentBits[t] = antecedentBits.get(t, 0) | (1 << k)
+        termCounts[t] = termCounts.get(t, 0) + 1
+    _, termRules, emptyRules = editable["compiled"]
+    _, conclusionRules, conclusionBits, negatedRules = editable["counterfactuals"]
+    oldKey = editable["ruleKeys"][k]
+    if None == oldKey:
+        emptyRules &= ~(1 << k)
+    else:
+        termRules[oldKey] &= ~(1 << k)
+    if not newRule[0]:
+        newKey = None
+        emptyRules |= 1 << k
+    else:
+        newKey = min(sorted(newRule[0]), key=termCounts.get)
+        termRules[newKey] = termRules.get(newKey, 0) | (1 << k)
+    editable["ruleKeys"][k] = newKey
+    conclusionRules[oldRule[1]].remove(k)
+    conclusionBits[oldRule[1]] &= ~(1 << k)
+    if not conclusionRules[oldRule[1]]:
+        conclusionRules.pop(oldRule[1])
+        conclusionBits.pop(oldRule[1])
+    bisect.insort(conclusionRules.setdefault(newRule[1], []), k)
+    conclusionBits[newRule[1]] = conclusionBits.get(newRule[1], 0) | (1 << k)
+    negatedRules &= ~(1 << k)
+    if any(('-' == t[:1]) for t in newRule[0]):
+        negatedRules |= 1 << k
+    editable["compiled"] = (theory, termRules, emptyRules)
+    editable["counterfactuals"] = (editable["compiled"], conclusionRules, conclusionBits, negatedRules)
+    theoryEdited(theory)
+    return [theory[j] for j in iterBits(askAbout)]
+
+# Answers are keyed by the ids of the theories they depend on. Besides the answers, a cache keeps every theory it
+# has answers for, with their keys, so that no other list can get the id of such a theory, and forgets it with its
+# last answer. Every live cache is registered, and updateTheory and updateEditableTheory drop the answers of the
+# theory they edit from all of them; a theory edited otherwise must be passed to theoryEdited.
+class QueryCache(dict):
+    # a dict that the registry can hold weakly, so that a cache nobody uses is freed with its answers
+    pass
+
+queryCaches = weakref.WeakValueDictionary()
+
+def makeQueryCache(maxEntries=65536):
+    cache = QueryCache(entries=collections.OrderedDict(), theories={}, maxEntries=maxEntries, hits=0, misses=0, evictions=0)
+    queryCaches[id(cache)] = cache
+    return cache
+
+def dropCachedQuery(cache, key):
+    theories, _ = cache["entries"].pop(key)
+    for t in theories:
+        if id(t) in cache["theories"]:
+            keys = cache["theories"][id(t)][1]
+            keys.discard(key)
+            if not keys:
+                cache["theories"].pop(id(t))
+
+def invalidateTheory(cache, theory):
+    if id(theory) in cache["theories"]:
+        for key in list(cache["theories"][id(theory)][1]):
+            dropCachedQuery(cache, key)
+
+def theoryEdited(theory):
+    for cache in list(queryCaches.values()):
+        invalidateTheory(cache, theory)
+
+def cachedQuery(cache, key, theories, compute):
+    # answers are shared between callers and must not be modified
+    entries = cache["entries"]
+    if key in entries:
+        entries.move_to_end(key)
+        cache["hits"] = cache["hits"] + 1
+        return entries[key][1]
+    cache["misses"] = cache["misses"] + 1
+    answer = compute()
+    entries[key] = (theories, answer)
+    for t in theories:
+        cache["theories"].setdefault(id(t), (t, set()))[1].add(key)
+    if len(entries) > cache["maxEntries"]:
+        dropCachedQuery(cache, next(iter(entries)))
+        cache["evictions"] = cache["evictions"] + 1
+    return answer
+
+def cachedGetAndExplainConclusion(cache, premise, theory):
+    premise = frozenset(premise)
+    key = ("explain", id(theory), premise)
+    return cachedQuery(cache, key, [theory], lambda: getAndExplainConclusion(premise, theory))
+
+def cachedGetConclusionsRanking(cache, premise, theories):
+    premise = frozenset(premise)
+    key = ("ranking", tuple(id(t) for t in theories), premise)
+    return cachedQuery(cache, key, list(theories), lambda: getConclusionsRanking(premise, theories))
+
+def cachedGetDefaultExemplar(cache, conclusion, theory):
+    key = ("exemplar", id(theory), conclusion)
+    return cachedQuery(cache, key, [theory], lambda: getDefaultExemplar(conclusion, theory))
+
 def printRule(rule):
     ants = sorted([(getPrefix(x), x) for x in rule[0]])
     retq = ""
@@ -292,4 +835,4 @@ def printRule(rule):
     return retq
 
 if "__main__" == __name__:
-    runTest()
+    runTest(processes=os.cpu_count())
@@ -0,0 +1,209 @@
+import contextlib
+import io
+import itertools
+import os
+import random
+import sys
+from heapq import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import recordloader
+import testing
+import training
+
+# The fast paths of training.py and testing.py are meant to give exactly the answers of the plain versions.
+# Each test compares them on a fixed slice of records_dfl.txt.
+
+recordsPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'records_dfl.txt')
+records = list(itertools.islice(recordloader.iterRecordLines(recordsPath), 400))
+mutexsets = training.mutexsetsFromRecords(records)
+mutexMap = training.getMutexMap(mutexsets)
+vocabulary = sorted(set().union(*records))
+datasets = training.splitDataset(training.datasetFromRecords(records), mutexsets)
+
+def referencePreferredConclusion(applicable, dataset, correct):
+    surprises = {}
+    corrects = {}
+    for e in applicable:
+        counts = corrects if correct[e] else surprises
+        counts[dataset[e][1]] = counts.get(dataset[e][1], 0) + 1
+    if not surprises:
+        return None, -1, -100, -100
+    conclusion = min(surprises, key=lambda c: (-surprises[c], c))
+    maxgain = surprises[conclusion]
+    gain = maxgain - sum([n for c, n in corrects.items() if conclusion != c])
+    return conclusion, (maxgain + corrects.get(conclusion, 0))/len(applicable), gain, maxgain
+
+def referenceRuleSearch(dataset, theory, selected, mutexMap, epoch, beamWidth):
+    # the rule search on sets of examples, scoring every candidate and expanding every rule on every level
+    decidedBy = [None]*len(dataset)
+    for k, r in enumerate(theory):
+        for e, (premise, _) in enumerate(dataset):
+            if r[0] <= premise:
+                decidedBy[e] = k
+    correct = [(None != k) and (theory[k][1] == dataset[e][1]) for e, k in enumerate(decidedBy)]
+    def extensions(premise):
+        present = set().union(*[p for p, _ in dataset if premise <= p])
+        return [v for v in selected if (v in present) and (v not in premise) and not any([v in mutexMap.get(t, ()) for t in premise])]
+    best = (0, None, None)
+    addedPrems = set([r[0] for r in theory])
+    pushes = 0
+    for level in range(1 + len(theory)):
+        examples = [e for e, k in enumerate(decidedBy) if (None == k) or (k < level)]
+        queue = []
+        for parent in [frozenset()] + [r[0] for r in theory[:level]]:
+            cover = [e for e in examples if parent <= dataset[e][0]]
+            for v in extensions(parent):
+                premise = parent.union([v])
+                if premise in addedPrems:
+                    continue
+                addedPrems.add(premise)
+                applicable = [e for e in cover if v in dataset[e][0]]
+                conclusion, reliability, gain, maxgain = referencePreferredConclusion(applicable, dataset, correct)
+                if conclusion in epoch:
+                    continue
+                if (None != conclusion) and (best[0] < maxgain):
+                    heappush(queue, (-reliability, -maxgain, -gain, pushes, premise, applicable))
+                    pushes = pushes + 1
+                if best[0] < gain:
+                    best = (gain, (premise, conclusion), level)
+        queue = nsmallest(beamWidth, queue)
+        while queue:
+            _, _, _, _, premise, covered = heappop(queue)
+            for v in extensions(premise):
+                crpremise = premise.union([v])
+                if crpremise in addedPrems:
+                    continue
+                addedPrems.add(crpremise)
+                applicable = [e for e in covered if v in dataset[e][0]]
+                if not applicable:
+                    continue
+                conclusion, reliability, gain, maxgain = referencePreferredConclusion(applicable, dataset, correct)
+                if (None == conclusion) or (conclusion in epoch):
+                    continue
+                if best[0] < maxgain:
+                    heappush(queue, (-reliability, -maxgain, -gain, pushes, crpremise, applicable))
+                    pushes = pushes + 1
+                if beamWidth < len(queue):
+                    queue = nsmallest(beamWidth, queue)
+                if best[0] < gain:
+                    best = (gain, (crpremise, conclusion), level)
+    return best
+
+def referenceHeRO(dataset, mutexset, mutexMap, vocabulary, restrictions=None, beamWidth=10):
+    dataset = training.prepConflictDataset(dataset, mutexset)
+    prefix = training.qualityPrefix(list(mutexset)[0])
+    selected = [v for v in vocabulary if (v not in mutexset) and ((None == restrictions) or (prefix not in restrictions) or (training.qualityPrefix(v) in restrictions[prefix]))]
+    theory = []
+    epoch = set()
+    while True:
+        gain, rule, level = referenceRuleSearch(dataset, theory, selected, mutexMap, epoch, beamWidth)
+        if 0 >= gain:
+            return theory
+        epoch.add(rule[1])
+        if not mutexset.difference(epoch):
+            epoch = set()
+        theory = theory[:level] + [rule] + theory[level:]
+
+def trainedTheory(ms, ds, restrictions=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return training.HeRO(ds, ms, mutexMap, vocabulary, restrictions=restrictions)
+
+theories = {}
+
+def trainedTheories():
+    # one theory per prefix, trained once for all tests
+    if not theories:
+        for ms, ds in zip(mutexsets, datasets):
+            theories[training.qualityPrefix(list(ms)[0])] = trainedTheory(ms, ds)
+    return theories
+
+def test_pruned_search_finds_reference_theories():
+    for ms, ds in zip(mutexsets, datasets):
+        prefix = training.qualityPrefix(list(ms)[0])
+        if prefix not in ['', 'color', 'dimension', 'fullness']:
+            continue
+        for r in [None, training.restrictionBias]:
+            assert referenceHeRO(ds, ms, mutexMap, vocabulary, restrictions=r) == trainedTheory(ms, ds, restrictions=r)
+
+def test_compiled_inference_matches_linear_walk():
+    for prefix, theory in trainedTheories().items():
+        # a rule without antecedent applies to every premise
+        for th in [theory, theory[:len(theory)//2] + [(frozenset(), theory[0][1])] + theory[len(theory)//2:]]:
+            compiled = testing.compileTheory(th)
+            for r in records:
+                _, premise = testing.makeTestcase(r, prefix)
+                premise = frozenset(premise)
+                assert testing.getAndExplainConclusionCompiled(premise, compiled) == testing.getAndExplainConclusion(premise, th)
+                assert testing.getConclusionRankingCompiled(premise, compiled) == testing.getConclusionRankingInternal(premise, th)
+
+def negatedVariant(theory):
+    # counterfactual premises negate terms, which only rules with negated antecedent terms can then match
+    retq = []
+    for k, r in enumerate(theory):
+        if (1 == k % 3) and r[0]:
+            t = min(r[0])
+            r = (r[0].difference([t]).union(['-' + t]), r[1])
+        retq.append(r)
+    return retq
+
+def test_compiled_counterfactuals_match_reference():
+    for prefix, theory in trainedTheories().items():
+        for th in [theory, negatedVariant(theory)]:
+            compiledCF = testing.compileCounterfactuals(th)
+            conclusions = sorted(set([r[1] for r in th]))
+            for r in records[::8]:
+                _, premise = testing.makeTestcase(r, prefix)
+                premise = frozenset(premise)
+                if None == testing.getAndExplainConclusion(premise, th)[0]:
+                    continue
+                for c in conclusions:
+                    assert testing.getAndCounterfactuallyExplainConclusionCompiled(premise, compiledCF, c) == testing.getAndCounterfactuallyExplainConclusion(premise, th, c)
+
+def test_editable_updates_match_rebuild():
+    rng = random.Random(0)
+    for prefix, theory in trainedTheories().items():
+        if len(theory) < 5:
+            continue
+        plain = list(theory)
+        editable = testing.makeEditableTheory(list(theory))
+        terms = sorted(set().union(*[r[0] for r in theory]))
+        conclusions = sorted(set([r[1] for r in theory]))
+        premises = [frozenset(testing.makeTestcase(r, prefix)[1]) for r in records[::10]]
+        for p in premises:
+            testing.explainEditable(editable, p)
+        for _ in range(30):
+            oldRule = rng.choice(plain + [(frozenset(['nothing']), 'nothing')])
+            newRule = (frozenset(rng.sample(terms, rng.randint(0, 3))), rng.choice(conclusions + ['new']))
+            assert testing.updateEditableTheory(editable, oldRule, newRule) == testing.updateTheory(oldRule, plain, newRule)
+            assert plain == editable["theory"]
+            rebuilt = testing.makeEditableTheory(list(plain))
+            for key in ["positions", "antecedentBits", "termCounts"]:
+                assert {k: v for k, v in editable[key].items() if v} == {k: v for k, v in rebuilt[key].items() if v}
+            assert editable["counterfactuals"][1:] == rebuilt["counterfactuals"][1:]
+            for p in premises:
+                explanation = testing.getAndExplainConclusion(p, plain)
+                assert testing.explainEditable(editable, p) == explanation
+                assert testing.getAndExplainConclusionCompiled(p, editable["compiled"]) == explanation
+                if None != explanation[0]:
+                    c = rng.choice(sorted(editable["counterfactuals"][1]))
+                    assert testing.getAndCounterfactuallyExplainConclusionCompiled(p, editable["counterfactuals"], c) == testing.getAndCounterfactuallyExplainConclusion(p, plain, c)
+
+def test_cached_answers_follow_edits():
+    premise = frozenset(['a', 'b'])
+    theory = [(frozenset(['a']), 'x'), (frozenset(['a', 'b']), 'y')]
+    other = [(frozenset(['b']), 'u')]
+    cache = testing.makeQueryCache()
+    assert testing.cachedGetAndExplainConclusion(cache, premise, theory)[0][1] == 'y'
+    assert testing.cachedGetConclusionsRanking(cache, premise, [theory, other]) == [('y', 'u')]
+    assert testing.cachedGetDefaultExemplar(cache, 'y', theory)[0] == theory[1]
+    testing.updateTheory(theory[1], theory, (frozenset(['a', 'b']), 'z'))
+    assert testing.cachedGetAndExplainConclusion(cache, premise, theory) == testing.getAndExplainConclusion(premise, theory)
+    assert testing.cachedGetConclusionsRanking(cache, premise, [theory, other]) == [('z', 'u')]
+    assert testing.cachedGetDefaultExemplar(cache, 'y', theory) == (None, [])
+    editable = testing.makeEditableTheory(theory)
+    testing.updateEditableTheory(editable, theory[0], (frozenset(['a', 'b', 'c']), 'x'))
+    testing.updateEditableTheory(editable, theory[1], (frozenset(['b']), 'w'))
+    assert testing.cachedGetAndExplainConclusion(cache, premise, theory) == testing.getAndExplainConclusion(premise, theory)
+    assert testing.cachedGetConclusionsRanking(cache, premise, [theory, other]) == [('w', 'u')]
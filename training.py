@@ -1,6 +1,13 @@
-import ast
+import artifact
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
 import pickle
 import random
+import recordloader
 import time
 from heapq import *
 
@@ -17,13 +24,13 @@ def datasetFromRecords(records):
     return dataset
 
 def splitDataset(pairs, mutexsets):
-    retq = {}
+    # one dataset per mutex set, in the same order, so that callers can zip them together
+    retq = {qualityPrefix(list(ms)[0]): [] for ms in mutexsets}
     for pair in pairs:
         premise, conclusion = pair
         prefix = qualityPrefix(conclusion)
-        if prefix not in retq:
-            retq[prefix] = []
-        retq[prefix].append(pair)
+        if prefix in retq:
+            retq[prefix].append(pair)
     return list(retq.values())
 
 def getMutexMap(mutexsets):
@@ -62,30 +69,142 @@ def prepConflictDataset(pairs, mutexset):
            retq.append((premise, argMax))
     return retq
 
-def compatible(premise, term, mutexMap):
-    if term not in mutexMap:
-        return True
+def bitsFromIds(ids):
+    buf = bytearray()
+    for k in ids:
+        byte = k >> 3
+        if len(buf) <= byte:
+            buf.extend(bytes(1 + byte - len(buf)))
+        buf[byte] |= 1 << (k & 7)
+    return int.from_bytes(buf, 'little')
+
+def iterBits(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def buildPostings(dataset, vocabulary):
+    postings = {v: [] for v in vocabulary}
+    for k, e in enumerate(dataset):
+        for t in e[0]:
+            if t in postings:
+                postings[t].append(k)
+    return postings
+
+def encodeDataset(dataset, postings):
+    conclusionIds = {}
+    for k, e in enumerate(dataset):
+        conc = e[1]
+        if conc not in conclusionIds:
+            conclusionIds[conc] = []
+        conclusionIds[conc].append(k)
+    termBits = {v: bitsFromIds(ids) for v, ids in postings.items()}
+    conclusionBits = {c: bitsFromIds(ids) for c, ids in conclusionIds.items()}
+    return termBits, conclusionBits
+
+def intersectPostings(premise, postings, postingSets):
+    terms = sorted(premise, key=lambda t: len(postings.get(t, [])))
+    if not terms:
+        return None
+    retq = postings.get(terms[0], [])
+    for t in terms[1:]:
+        s = postingSets.get(t, ())
+        retq = [k for k in retq if k in s]
+    return retq
+
+def compileLegality(vocabulary, mutexMap, restrictions):
+    terms = list(vocabulary)
+    termIds = {v: k for k, v in enumerate(terms)}
+    fullMask = (1 << len(terms)) - 1
+    allowed = {}
+    prefixMasks = {}
+    for v, k in termIds.items():
+        mask = fullMask & ~(1 << k)
+        for t in mutexMap.get(v, ()):
+            if t in termIds:
+                mask &= ~(1 << termIds[t])
+        allowed[v] = mask
+        prefix = qualityPrefix(v)
+        prefixMasks[prefix] = prefixMasks.get(prefix, 0) | (1 << k)
+    restrictionMasks = {}
+    if None != restrictions:
+        for crProp, prefixes in restrictions.items():
+            restrictionMasks[crProp] = 0
+            for prefix in prefixes:
+                restrictionMasks[crProp] |= prefixMasks.get(prefix, 0)
+    return terms, termIds, allowed, restrictionMasks
+
+def legalMask(premise, baseMask, allowed):
+    retq = baseMask
     for t in premise:
-        if t in mutexMap[term]:
-            return False
-    return True
-    
-def preferredConclusion(dataset, decidedByRule):
+        retq &= allowed.get(t, 0)
+    return retq
+
+def extensionMask(premise, index):
+    postings, postingSets, exampleMasks, cache = index
+    if premise not in cache:
+        ids = intersectPostings(premise, postings, postingSets)
+        if ids is None:
+            ids = range(len(exampleMasks))
+        present = 0
+        for k in ids:
+            present |= exampleMasks[k]
+        cache[premise] = present
+    return cache[premise]
+
+def premiseBits(premise, termBits, allBits):
+    retq = allBits
+    for t in premise:
+        retq &= termBits.get(t, 0)
+    return retq
+
+def theoryDecisions(dataset, theory):
+    # the rule deciding an example is the highest priority rule that applies to it
+    terms = set()
+    for r in theory:
+        terms.update(r[0])
+    termBits, _ = encodeDataset(dataset, buildPostings(dataset, terms))
+    allBits = (1 << len(dataset)) - 1
+    decidedByRule = [None]*len(dataset)
+    for r in theory:
+        for e in iterBits(premiseBits(r[0], termBits, allBits)):
+            decidedByRule[e] = r
+    return decidedByRule
+
+def decisionPartition(decidedByRule, theory):
+    # The examples as a bitset per deciding rule, and under None the undecided ones. Keyed by rule, the partition
+    # needs no shifting when a rule is inserted, and the examples ruleSearch looks at on level L, the undecided ones
+    # and those decided below L, are the union of None and the partitions of theory[:L].
+    ids = {r: [] for r in theory}
+    ids[None] = []
+    for k, r in enumerate(decidedByRule):
+        ids[r].append(k)
+    return {r: bitsFromIds(x) for r, x in ids.items()}
+
+def ruleSupport(dataset, theory):
+    support = {r: [0, 0] for r in theory}
+    for e, r in zip(dataset, theoryDecisions(dataset, theory)):
+        if None != r:
+            if e[1] == r[1]:
+                support[r][0] = support[r][0] + 1
+            else:
+                support[r][1] = support[r][1] + 1
+    return support
+
+def preferredConclusion(applicable, conclusionBits, correctBits):
     surprises = {}
     corrects = {}
-    for e in dataset:
-        fact, conc = e
-        expected = None
-        if None != decidedByRule[e]:
-            expected = decidedByRule[e][1]
-        if (None == expected) or (conc != expected):
-            if conc not in surprises:
-                surprises[conc] = 0
-            surprises[conc] = surprises[conc] + 1
-        elif conc == expected:
-            if conc not in corrects:
-                corrects[conc] = 0
-            corrects[conc] = corrects[conc] + 1
+    for conc, bits in conclusionBits.items():
+        covered = applicable & bits
+        if not covered:
+            continue
+        correct = (covered & correctBits).bit_count()
+        surprise = covered.bit_count() - correct
+        if surprise:
+            surprises[conc] = surprise
+        if correct:
+            corrects[conc] = correct
     if not surprises:
         return None, -1, -100, -100
     surprises = sorted([(-surprises[x], x) for x in surprises])
@@ -98,133 +217,438 @@ def preferredConclusion(dataset, decidedByRule):
     correctConclusion = maxgain
     if conclusion in corrects:
         correctConclusion = correctConclusion + corrects[conclusion]
-    reliability = (correctConclusion)/len(dataset)
+    reliability = (correctConclusion)/applicable.bit_count()
     return conclusion, reliability, gain, maxgain
 
-def ruleSearch(dataset, mutexset, mutexMap, theory, vocabulary, decidedByRule, ruleAtLevel, epoch):
+def conclusionBound(applicable, conclusionBits, openBits, epoch):
+    # the surprises a refinement can gain for a conclusion only shrink as its coverage does
+    bound = 0
+    for conc, bits in conclusionBits.items():
+        if conc not in epoch:
+            bound = max(bound, (applicable & bits & openBits).bit_count())
+    return bound
+
+# Opt-in instrumentation of HeRO and ruleSearch. While disabled this is None, and the search only tests it once per
+# level, beam pop and preferredConclusion call. While enabled it holds one report of counters and timers per prefix
+# and, if asked for, the events of a Chrome trace (chrome://tracing, ui.perfetto.dev).
+instrumentation = None
+
+def enableInstrumentation(trace=False):
+    global instrumentation
+    instrumentation = {"reports": {}, "current": None, "events": [] if trace else None}
+    return instrumentation
+
+def disableInstrumentation():
+    global instrumentation
+    retq = instrumentation
+    instrumentation = None
+    return retq
+
+def startReport(prefix, examples, vocabularySize):
+    report = {"examples": examples, "vocabulary": vocabularySize, "ruleSearchCalls": 0, "ruleSearchTime": 0.0, "ruleTimes": [], "levels": 0, "levelTime": 0.0, "candidates": 0, "illegalExtensions": 0, "preferredConclusionCalls": 0, "examplesScanned": 0, "heapPushes": 0, "heapPops": 0, "tid": len(instrumentation["reports"])}
+    instrumentation["reports"][prefix] = report
+    instrumentation["current"] = report
+    if None != instrumentation["events"]:
+        instrumentation["events"].append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": report["tid"], "args": {"name": "HeRO '%s'" % prefix}})
+    return report
+
+def traceEvent(report, name, start, end, args):
+    if None != instrumentation["events"]:
+        instrumentation["events"].append({"name": name, "ph": "X", "ts": start*1e6, "dur": (end - start)*1e6, "pid": os.getpid(), "tid": report["tid"], "args": args})
+
+def mergeInstrumentation(stats):
+    # adds what a worker process recorded, renumbering its trace threads after the ones already here
+    tids = {}
+    for prefix, report in stats["reports"].items():
+        tids[report["tid"]] = len(instrumentation["reports"])
+        report["tid"] = tids[report["tid"]]
+        instrumentation["reports"][prefix] = report
+    if (None != instrumentation["events"]) and (None != stats["events"]):
+        for e in stats["events"]:
+            e["tid"] = tids[e["tid"]]
+            instrumentation["events"].append(e)
+
+def printInstrumentationReport(stats):
+    print("%-14s %8s %6s %6s %10s %8s %12s %9s %14s %10s %10s %10s" % ("prefix", "examples", "vocab", "rules", "searchTime", "levels", "candidates", "illegal", "preferredCalls", "scanned", "pushes", "pops"))
+    for prefix, r in stats["reports"].items():
+        print("%-14s %8d %6d %6d %9.2fs %8d %12d %9d %14d %10d %10d %10d" % (repr(prefix), r["examples"], r["vocabulary"], len(r["ruleTimes"]), r["ruleSearchTime"], r["levels"], r["candidates"], r["illegalExtensions"], r["preferredConclusionCalls"], r["examplesScanned"], r["heapPushes"], r["heapPops"]))
+
+def writeChromeTrace(path, stats):
+    with open(path, "w") as outfile:
+        json.dump({"traceEvents": stats["events"] or [], "displayTimeUnit": "ms"}, outfile)
+
+def scoreCandidate(premise, levelKey, cover, aux, scores, conclusionBits, correctBits):
+    if premise not in scores:
+        scores[premise] = (cover, {})
+    byLevel = scores[premise][1]
+    if levelKey not in byLevel:
+        byLevel[levelKey] = preferredConclusion(aux, conclusionBits, correctBits)
+        if None != instrumentation:
+            report = instrumentation["current"]
+            report["preferredConclusionCalls"] = report["preferredConclusionCalls"] + 1
+            report["examplesScanned"] = report["examplesScanned"] + aux.bit_count()
+    return byLevel[levelKey]
+
+def rescoreAfterInsert(scores, decided):
+    # Levels are keyed by the last rule they include, which inserting a rule does not reorder. Only the
+    # examples in decided change their deciding rule, so a premise covering none of them keeps its scores.
+    for premise in [p for p, entry in scores.items() if entry[0] & decided]:
+        del scores[premise]
+
+def outOfTime(deadline):
+    return (None != deadline) and (deadline < time.perf_counter())
+
+def ruleSearch(dataset, theory, index, legality, partition, epoch, termBits, conclusionBits, scores, beamWidth=10, deadline=None):
     bestGain = 0
     bestPremise = None
     bestConclusion = None
     bestLevel = None
     bestApplicable = None
+    terms, allowed, baseMask = legality
+    allBits = (1 << len(dataset)) - 1
+    correctBits = 0
+    for r in theory:
+        correctBits |= partition[r] & conclusionBits.get(r[1], 0)
+    openBits = allBits & ~correctBits
+    for conc, bits in conclusionBits.items():
+        if conc in epoch:
+            openBits &= ~bits
+    expanded = set()
     levelRange = [len(theory)]
     levelRange = range(1 + len(theory))
     addedPrems = set([x[0] for x in theory])
+    pushes = 0
+    report = instrumentation["current"] if None != instrumentation else None
+    levelBits = partition[None]
     for level in levelRange:
-        theoryUpToLevel = [(frozenset(), None)] + theory[:level]
-        datasetUpToLevel = [x for x in dataset if (None == decidedByRule[x]) or (level > ruleAtLevel[decidedByRule[x]])]
+        if outOfTime(deadline):
+            break
+        if None != report:
+            levelStart = time.perf_counter()
+            levelCandidates = len(addedPrems)
+            levelPushes = pushes
+        # the rules below theory[level - 1] were all expanded on earlier levels, a timeout being the only way out
+        theoryUpToLevel = [theory[level - 1]] if level else [(frozenset(), None)]
+        if level:
+            levelBits |= partition[theory[level - 1]]
+        levelKey = theory[level - 1] if level else None
         queue = []
         for r in theoryUpToLevel:
-            for v in vocabulary:
-                if (v not in mutexset) and (v not in r[0]):
-                    if not compatible(r[0], v, mutexMap):
-                        continue
-                    premise = r[0].union([v])
-                    if premise in addedPrems:
+            if outOfTime(deadline):
+                break
+            # every legal extension of an expanded premise is already in addedPrems
+            if r[0] in expanded:
+                continue
+            expanded.add(r[0])
+            ruleCover = premiseBits(r[0], termBits, allBits)
+            ruleBits = ruleCover & levelBits
+            pruned = conclusionBound(ruleBits, conclusionBits, openBits, epoch) <= bestGain
+            ruleLegal = legalMask(r[0], baseMask, allowed)
+            if None != report:
+                report["illegalExtensions"] = report["illegalExtensions"] + (extensionMask(r[0], index) & ~ruleLegal).bit_count()
+            for k in iterBits(extensionMask(r[0], index) & ruleLegal):
+                v = terms[k]
+                premise = r[0].union([v])
+                if premise in addedPrems:
+                    continue
+                addedPrems.add(premise)
+                aux = ruleBits & termBits[v]
+                if pruned or ((aux & openBits).bit_count() <= bestGain):
+                    continue
+                conclusion, reliability, gain, maxgain = scoreCandidate(premise, levelKey, ruleCover & termBits[v], aux, scores, conclusionBits, correctBits)
+                if conclusion in epoch:
+                    continue
+                if (None != conclusion) and (bestGain < maxgain):
+                    heappush(queue, (-reliability, -maxgain, -gain, pushes, premise, aux, conclusion, ruleLegal & allowed[v]))
+                    pushes = pushes + 1
+                if bestGain < gain:
+                    bestGain = gain
+                    bestPremise = premise
+                    bestConclusion = conclusion
+                    bestLevel = level
+                    bestApplicable = aux
+                    #queue = []
+        # a sorted list is a valid heap
+        queue = nsmallest(beamWidth, queue)
+        while queue:
+            if outOfTime(deadline):
+                break
+            _, _, _, _, premise, applicableDataset, _, premiseLegal = heappop(queue)
+            if None != report:
+                report["heapPops"] = report["heapPops"] + 1
+                report["illegalExtensions"] = report["illegalExtensions"] + (extensionMask(premise, index) & ~premiseLegal).bit_count()
+            premiseCover = premiseBits(premise, termBits, allBits)
+            pruned = conclusionBound(applicableDataset, conclusionBits, openBits, epoch) <= bestGain
+            for k in iterBits(extensionMask(premise, index) & premiseLegal):
+                v = terms[k]
+                crpremise = premise.union([v])
+                if crpremise in addedPrems:
+                    continue
+                addedPrems.add(crpremise)
+                aux = applicableDataset & termBits[v]
+                if aux:
+                    if pruned or ((aux & openBits).bit_count() <= bestGain):
                         continue
-                    addedPrems.add(premise)
-                    aux = [x for x in datasetUpToLevel if not premise.difference(x[0])]
-                    conclusion, reliability, gain, maxgain = preferredConclusion(aux, decidedByRule)
-                    if conclusion in epoch:
+                    nconclusion, reliability, ngain, nmaxgain = scoreCandidate(crpremise, levelKey, premiseCover & termBits[v], aux, scores, conclusionBits, correctBits)
+                    if (None == nconclusion) or (nconclusion in epoch):
                         continue
-                    if (None != conclusion) and (bestGain < maxgain):
-                        heappush(queue, (-reliability, -maxgain, -gain, premise, aux, conclusion))
-                    if bestGain < gain:
-                        bestGain = gain
-                        bestPremise = premise
-                        bestConclusion = conclusion
+                    if bestGain < nmaxgain:
+                        heappush(queue, (-reliability, -nmaxgain, -ngain, pushes, crpremise, aux, nconclusion, premiseLegal & allowed[v]))
+                        pushes = pushes + 1
+                    if beamWidth < len(queue):
+                        queue = nsmallest(beamWidth, queue)
+                    if bestGain < ngain:
+                        bestGain = ngain
+                        bestPremise = crpremise
+                        bestConclusion = nconclusion
                         bestLevel = level
                         bestApplicable = aux
                         #queue = []
-        queue = queue[:10]
-        while queue:
-            _, _, _, premise, applicableDataset, _ = heappop(queue)
-            for v in vocabulary:
-                if (v not in mutexset) and (v not in premise) and compatible(premise, v, mutexMap):
-                    crpremise = premise.union([v])
-                    if crpremise in addedPrems:
-                        continue
-                    addedPrems.add(crpremise)
-                    aux = [x for x in applicableDataset if v in x[0]]
-                    if aux:
-                        nconclusion, reliability, ngain, nmaxgain = preferredConclusion(aux, decidedByRule)
-                        if (None == nconclusion) or (conclusion in epoch):
-                            continue
-                        if bestGain < nmaxgain:
-                            heappush(queue, (-reliability, -nmaxgain, -ngain, crpremise, aux, nconclusion))
-                        if 10 < len(queue):
-                            queue = queue[:10]
-                        if bestGain < ngain:
-                            bestGain = ngain
-                            bestPremise = crpremise
-                            bestConclusion = nconclusion
-                            bestLevel = level
-                            bestApplicable = aux
-                            #queue = []
+        if None != report:
+            levelEnd = time.perf_counter()
+            report["levels"] = report["levels"] + 1
+            report["levelTime"] = report["levelTime"] + (levelEnd - levelStart)
+            report["candidates"] = report["candidates"] + (len(addedPrems) - levelCandidates)
+            report["heapPushes"] = report["heapPushes"] + (pushes - levelPushes)
+            traceEvent(report, "level %d" % level, levelStart, levelEnd, {"candidates": len(addedPrems) - levelCandidates, "pushes": pushes - levelPushes, "bestGain": bestGain})
     if 0 < bestGain:
         return True, (bestPremise, bestConclusion), bestLevel, bestApplicable
     else:
         return False, None, None, None
 
-def HeRO(dataset, mutexset, mutexMap, vocabulary, epochal=True, restrictions=None):
+def heroFingerprint(dataset, mutexset, vocabularySel, epochal, beamWidth, theory):
+    # identifies the inputs of a HeRO run, so that a checkpoint is only resumed by the run that wrote it
+    digest = hashlib.sha256()
+    digest.update(repr((sorted(mutexset), vocabularySel, epochal, beamWidth, [(sorted(r[0]), r[1]) for r in theory])).encode('utf-8'))
+    for premise, conclusion in dataset:
+        digest.update(repr((sorted(premise), conclusion)).encode('utf-8'))
+    return digest.hexdigest()
+
+def writeCheckpoint(path, fingerprint, theory, epoch, done):
+    # the partition of the examples is rebuilt from the theory, and the score cache is only a cache,
+    # so the theory and the epoch are all the search state there is
+    with open(path + ".tmp", "wb") as outfile:
+        pickle.dump({"fingerprint": fingerprint, "theory": theory, "epoch": epoch, "done": done}, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(path + ".tmp", path)
+
+def readCheckpoint(path, fingerprint):
+    try:
+        with open(path, "rb") as infile:
+            data = pickle.load(infile)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if (not isinstance(data, dict)) or (fingerprint != data.get("fingerprint")):
+        return None
+    return data
+
+def checkpointPath(checkpointDir, mutexset):
+    return os.path.join(checkpointDir, "hero_%s.checkpoint" % qualityPrefix(list(mutexset)[0]))
+
+def HeRO(dataset, mutexset, mutexMap, vocabulary, epochal=True, restrictions=None, beamWidth=10, ruleTime=None, theoryTime=None, legality=None, theory=None, checkpoint=None, checkpointRules=None, checkpointTime=None):
+    # with a checkpoint path, the search state is saved there every checkpointRules rules or checkpointTime seconds,
+    # and when the search ends; a run with the same inputs continues from it with the same result
     dataset = prepConflictDataset(dataset, mutexset)
-    theory = []
+    theory = list(theory) if theory else []
     work = True
-    decidedByRule = {x: None for x in dataset}
-    ruleAtLevel = {}
     epoch = set()
-    vocabularySel = vocabulary
-    print("HeRO for prefix '%s'" % qualityPrefix(list(mutexset)[0]))
-    if None != restrictions:
-        crProp = qualityPrefix(list(mutexset)[0])
-        if crProp in restrictions:
-            vocabularySel = [x for x in vocabulary if qualityPrefix(x) in restrictions[crProp]]
-    while work:
-        work, rule, level, bestApplicable = ruleSearch(dataset, mutexset, mutexMap, theory, vocabularySel, decidedByRule, ruleAtLevel, epoch)
+    crProp = qualityPrefix(list(mutexset)[0])
+    print("HeRO for prefix '%s'" % crProp)
+    if None == legality:
+        legality = compileLegality(vocabulary, mutexMap, restrictions)
+    terms, termIds, allowed, restrictionMasks = legality
+    baseMask = restrictionMasks.get(crProp, (1 << len(terms)) - 1)
+    for v in mutexset:
+        if v in termIds:
+            baseMask &= ~(1 << termIds[v])
+    vocabularySel = [terms[k] for k in iterBits(baseMask)]
+    if None != checkpoint:
+        fingerprint = heroFingerprint(dataset, mutexset, vocabularySel, epochal, beamWidth, theory)
+        resumed = readCheckpoint(checkpoint, fingerprint)
+        if None != resumed:
+            theory = list(resumed["theory"])
+            epoch = set(resumed["epoch"])
+            work = not resumed["done"]
+            print("     resuming from %s with %d rules" % (checkpoint, len(theory)))
+        lastCheckpoint = time.perf_counter()
+        rulesSinceCheckpoint = 0
+    partition = decisionPartition(theoryDecisions(dataset, theory), theory)
+    postings = buildPostings(dataset, vocabularySel)
+    termBits, conclusionBits = encodeDataset(dataset, postings)
+    exampleMasks = [0]*len(dataset)
+    for v, ids in postings.items():
+        for k in ids:
+            exampleMasks[k] |= 1 << termIds[v]
+    index = (postings, {v: set(ids) for v, ids in postings.items()}, exampleMasks, {})
+    scores = {}
+    report = startReport(crProp, len(dataset), len(vocabularySel)) if None != instrumentation else None
+    theoryDeadline = None
+    if None != theoryTime:
+        theoryDeadline = time.perf_counter() + theoryTime
+    while work and not outOfTime(theoryDeadline):
+        deadline = theoryDeadline
+        if None != ruleTime:
+            deadline = time.perf_counter() + ruleTime
+            if None != theoryDeadline:
+                deadline = min(deadline, theoryDeadline)
+        if None != report:
+            searchStart = time.perf_counter()
+        work, rule, level, bestApplicable = ruleSearch(dataset, theory, index, (terms, allowed, baseMask), partition, epoch, termBits, conclusionBits, scores, beamWidth=beamWidth, deadline=deadline)
+        if None != report:
+            searchEnd = time.perf_counter()
+            report["ruleSearchCalls"] = report["ruleSearchCalls"] + 1
+            report["ruleSearchTime"] = report["ruleSearchTime"] + (searchEnd - searchStart)
+            if work:
+                report["ruleTimes"].append(searchEnd - searchStart)
+            traceEvent(report, "ruleSearch", searchStart, searchEnd, {"rule": str((sorted(rule[0]), rule[1])) if work else None, "level": level})
         print("    ", work, rule, level)
         if work:
             if epochal:
                 epoch.add(rule[1])
                 if not mutexset.difference(epoch):
                     epoch = set()
+            # the examples the new rule decides were undecided or decided below its level
+            for r in [None] + theory[:level]:
+                partition[r] &= ~bestApplicable
+            partition[rule] = bestApplicable
             theory = theory[:level] + [rule] + theory[level:]
-            for r in ruleAtLevel:
-                if level <= ruleAtLevel[r]:
-                    ruleAtLevel[r] = ruleAtLevel[r] + 1
-            ruleAtLevel[rule] = level
-            for e in bestApplicable:
-                decidedByRule[e] = rule
+            if None != checkpoint:
+                rulesSinceCheckpoint = rulesSinceCheckpoint + 1
+                if ((None != checkpointRules) and (checkpointRules <= rulesSinceCheckpoint)) or ((None != checkpointTime) and (lastCheckpoint + checkpointTime <= time.perf_counter())):
+                    writeCheckpoint(checkpoint, fingerprint, theory, epoch, False)
+                    lastCheckpoint = time.perf_counter()
+                    rulesSinceCheckpoint = 0
+            rescoreAfterInsert(scores, bestApplicable)
+    if None != checkpoint:
+        # a search cut short by theoryTime is not done, and continues when resumed
+        writeCheckpoint(checkpoint, fingerprint, theory, epoch, not work)
     return theory
 
-def multiHeRO(dataset, mutexsets, vocabulary, epochal=True, restrictions=None):
+def heroWorker(job):
+    ds, ms, mutexMap, vocabulary, epochal, restrictions, beamWidth, ruleTime, theoryTime, legality, theory, trace, checkpoint, checkpointRules, checkpointTime = job
+    if None != trace:
+        enableInstrumentation(trace=trace)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        theory = HeRO(ds, ms, mutexMap, vocabulary, epochal=epochal, restrictions=restrictions, beamWidth=beamWidth, ruleTime=ruleTime, theoryTime=theoryTime, legality=legality, theory=theory, checkpoint=checkpoint, checkpointRules=checkpointRules, checkpointTime=checkpointTime)
+    return theory, log.getvalue(), disableInstrumentation() if None != trace else None
+
+def multiHeRO(dataset, mutexsets, vocabulary, epochal=True, restrictions=None, processes=None, beamWidth=10, ruleTime=None, theoryTime=None, theories=None, checkpointDir=None, checkpointRules=10, checkpointTime=60.0):
     datasets = splitDataset(dataset, mutexsets)
     mutexMap = getMutexMap(mutexsets)
+    # a list keeps the vocabulary order, hence tie breaking, identical in every worker
+    vocabulary = list(vocabulary)
+    legality = compileLegality(vocabulary, mutexMap, restrictions)
+    initial = theories if None != theories else [None]*len(mutexsets)
+    checkpoints = [None]*len(mutexsets)
+    if None != checkpointDir:
+        os.makedirs(checkpointDir, exist_ok=True)
+        checkpoints = [checkpointPath(checkpointDir, ms) for ms in mutexsets]
     theories = []
     results = []
-    for ms, ds in zip(mutexsets, datasets):
-        theory = HeRO(ds, ms, mutexMap, vocabulary, epochal=epochal, restrictions=restrictions)
-        theories.append(theory)
+    if None == processes:
+        for ms, ds, th, ckpt in zip(mutexsets, datasets, initial, checkpoints):
+            theory = HeRO(ds, ms, mutexMap, vocabulary, epochal=epochal, restrictions=restrictions, beamWidth=beamWidth, ruleTime=ruleTime, theoryTime=theoryTime, legality=legality, theory=th, checkpoint=ckpt, checkpointRules=checkpointRules, checkpointTime=checkpointTime)
+            theories.append(theory)
+        return theories
+    # workers instrument themselves when this process is instrumented, and send their reports back
+    trace = (None != instrumentation["events"]) if None != instrumentation else None
+    jobs = [(ds, ms, mutexMap, vocabulary, epochal, restrictions, beamWidth, ruleTime, theoryTime, legality, th, trace, ckpt, checkpointRules, checkpointTime) for ms, ds, th, ckpt in zip(mutexsets, datasets, initial, checkpoints)]
+    with multiprocessing.Pool(processes) as pool:
+        for theory, log, stats in pool.imap(heroWorker, jobs):
+            print(log, end='')
+            if None != stats:
+                mergeInstrumentation(stats)
+            theories.append(theory)
     return theories
-    
-def trainWithSplitInternal(recordsDFL, splitRatio, mutexsets, runIndex, pathTemplate, restrictions=None):
+
+def warmStartMultiHeRO(theories, dataset, mutexsets, vocabulary, epochal=True, restrictions=None, processes=None, beamWidth=10, ruleTime=None, theoryTime=None):
+    # dataset holds the old and the new training pairs; theories were trained on the old ones, one per mutex set
+    # the update is not incremental: the decision pass and every rule search run over the whole merged dataset, so
+    # its cost still scales with all the data; what it saves is finding again the rules the theories already have
+    newTheories = multiHeRO(dataset, mutexsets, vocabulary, epochal=epochal, restrictions=restrictions, processes=processes, beamWidth=beamWidth, ruleTime=ruleTime, theoryTime=theoryTime, theories=theories)
+    lostSupport = []
+    for ms, ds, old, new in zip(mutexsets, splitDataset(dataset, mutexsets), theories, newTheories):
+        support = ruleSupport(prepConflictDataset(ds, ms), new)
+        lostSupport.append([(r, support[r][0], support[r][1]) for r in old if support[r][0] <= support[r][1]])
+    return newTheories, lostSupport
+
+def removeCheckpoints(checkpointDir, mutexsets):
+    for ms in mutexsets:
+        try:
+            os.remove(checkpointPath(checkpointDir, ms))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(checkpointDir)
+    except OSError:
+        pass
+
+def trainWithSplitInternal(recordsDFL, splitRatio, mutexsets, runIndex, pathTemplate, restrictions=None, processes=None, seed=None, checkpointDir=None):
     recordsShuffled = list(recordsDFL)
-    random.shuffle(recordsShuffled)
-    cut = int(len(records)*splitRatio)
+    rng = random if None == seed else random.Random(seed)
+    rng.shuffle(recordsShuffled)
+    cut = int(len(recordsShuffled)*splitRatio)
     trainRecords = recordsShuffled[:cut]
-    vocabulary = set().union(*trainRecords)
+    vocabulary = sorted(set().union(*trainRecords))
     train = datasetFromRecords(trainRecords)
     startTrain = time.perf_counter()
-    theories = multiHeRO(train, mutexsets, vocabulary, restrictions=restrictions)
+    theories = multiHeRO(train, mutexsets, vocabulary, restrictions=restrictions, processes=processes, checkpointDir=checkpointDir)
     endTrain = time.perf_counter()
-    with open(pathTemplate % (splitRatio, runIndex), "wb") as outfile:
-            pickle.dump({"durationTrain": endTrain-startTrain, "theory": theories, "mutexsets": mutexsets, "records": recordsShuffled, "restrictions": restrictions}, outfile)
+    artifact.writeArtifact(pathTemplate % (splitRatio, runIndex), {"durationTrain": endTrain-startTrain, "theory": theories, "mutexsets": mutexsets, "records": recordsShuffled, "restrictions": restrictions, "seed": seed})
+    if None != checkpointDir:
+        removeCheckpoints(checkpointDir, mutexsets)
 
-def trainWithSplit(recordsDFL, splitRatio, mutexsets, runCount, pathTemplate, restrictions=None):
+def trainWithSplit(recordsDFL, splitRatio, mutexsets, runCount, pathTemplate, restrictions=None, processes=None):
     for k in range(runCount):
-        trainWithSplitInternal(recordsDFL, splitRatio, mutexsets, k, pathTemplate, restrictions=restrictions)
+        trainWithSplitInternal(recordsDFL, splitRatio, mutexsets, k, pathTemplate, restrictions=restrictions, processes=processes)
+
+def validRunOutput(path, seed):
+    try:
+        data = artifact.loadRunData(path, records=False)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return False
+    return isinstance(data, dict) and ("theory" in data) and (seed == data.get("seed"))
+
+def trainingJobs(configs, splitRatio, runCount, baseSeed=0):
+    # run k of every config uses the same seed, so configs are compared on the same splits
+    return [(pathTemplate, restrictions, splitRatio, k, baseSeed + k) for pathTemplate, restrictions in configs for k in range(runCount)]
 
+def trainingWorker(job):
+    recordsDFL, mutexsets, pathTemplate, restrictions, splitRatio, runIndex, seed, checkpointDir = job
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        trainWithSplitInternal(recordsDFL, splitRatio, mutexsets, runIndex, pathTemplate, restrictions=restrictions, seed=seed, checkpointDir=checkpointDir)
+    return pathTemplate % (splitRatio, runIndex), log.getvalue()
 
-records = [ast.literal_eval(x) for x in open("records_dfl.txt").read().splitlines() if x.strip()]
+def runTrainingJobs(recordsDFL, mutexsets, jobs, processes=None, checkpoints=False):
+    # with checkpoints, an interrupted run continues its prefixes from <output path>.checkpoints
+    pending = []
+    for pathTemplate, restrictions, splitRatio, runIndex, seed in jobs:
+        path = pathTemplate % (splitRatio, runIndex)
+        if validRunOutput(path, seed):
+            print("Skipping %s, already trained with seed %d" % (path, seed))
+            continue
+        pending.append((recordsDFL, mutexsets, pathTemplate, restrictions, splitRatio, runIndex, seed, path + ".checkpoints" if checkpoints else None))
+    if None == processes:
+        for recordsDFL, mutexsets, pathTemplate, restrictions, splitRatio, runIndex, seed, checkpointDir in pending:
+            trainWithSplitInternal(recordsDFL, splitRatio, mutexsets, runIndex, pathTemplate, restrictions=restrictions, seed=seed, checkpointDir=checkpointDir)
+            print("Wrote %s" % (pathTemplate % (splitRatio, runIndex)))
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for path, log in pool.imap(trainingWorker, pending):
+            print(log, end='')
+            print("Wrote %s" % path)
+
+recordsPath = "records_dfl.txt"
+
+def __getattr__(name):
+    # the records are parsed on first use rather than when the module is imported; the list is shared with
+    # recordloader.loadRecords and must not be modified
+    if 'records' == name:
+        return recordloader.loadRecords(recordsPath)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 restrictionBias = {
     '': {'color', 'dimension', 'material', 'physical', 'price', 'shape', 'size', 'transparency', 'weight'},
@@ -245,7 +669,7 @@ restrictionBias = {
     'temperature': {'room', 'place', 'dampness', 'fullness'},
 }
 
-def runTraining():
+def mutexsetsFromRecords(records):
     mutexsetsByKey = {}
     for r in records:
         for e in r:
@@ -253,9 +677,13 @@ def runTraining():
             if k not in mutexsetsByKey:
                 mutexsetsByKey[k] = set()
             mutexsetsByKey[k].add(e)
-    mutexsets = list(mutexsetsByKey.values())
-    trainWithSplit(records, 0.7, mutexsets, 10, "no_bias_log_%0.02f_%d.log", restrictions=None)
-    trainWithSplit(records, 0.7, mutexsets, 10, "kn_bias_log_%0.02f_%d.log", restrictions=restrictionBias)
+    return list(mutexsetsByKey.values())
+
+def runTraining(processes=None, baseSeed=0):
+    records = recordloader.loadRecords(recordsPath)
+    mutexsets = mutexsetsFromRecords(records)
+    configs = [("no_bias_log_%0.02f_%d.log", None), ("kn_bias_log_%0.02f_%d.log", restrictionBias)]
+    runTrainingJobs(records, mutexsets, trainingJobs(configs, 0.7, 10, baseSeed), processes=processes, checkpoints=True)
 
 if "__main__" == __name__:
-    runTraining()
+    runTraining(processes=os.cpu_count())